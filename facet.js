@@ -0,0 +1,175 @@
+/**
+ * カテゴリーページでの絞り込み（価格帯・サブカテゴリー・タグ・お得情報）を実現するスクリプト
+ * facets/<カテゴリー>.json（このカテゴリーの商品だけの番号リストと商品データ）を組み合わせて、該当商品だけを表示する
+ */
+document.addEventListener('DOMContentLoaded', function() {
+    const filterContainer = document.getElementById('facet-filter');
+    if (!filterContainer) return;
+
+    const rootPath = document.querySelector('link[rel="stylesheet"]').getAttribute('href').replace('style.css', '');
+    const category = filterContainer.getAttribute('data-category');
+
+    // カテゴリー名の「/」はファイル名では「_」に置き換えられている
+    const fileName = category.replace(/[\/\\]/g, '_');
+    fetch(`${rootPath}facets/${encodeURIComponent(fileName)}.json`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Facet index file not found.');
+            }
+            return response.json();
+        })
+        .then(facetIndex => {
+            // 商品番号はこのカテゴリー内での並び順なので、カテゴリーの全商品は 0〜docs.length-1
+            const baseIds = facetIndex.docs.map((_doc, id) => id);
+            renderFacetFilter(filterContainer, facetIndex, baseIds, rootPath);
+        })
+        .catch(error => {
+            // 絞り込みが使えなくても、静的に生成された商品一覧はそのまま表示される
+            console.error('Error loading facet index:', error);
+        });
+});
+
+// 表示する絞り込みグループの定義
+const FACET_GROUPS = [
+    { key: 'flag', title: 'お得情報', labels: { sale: 'セール中', point: 'ポイント高還元', new_lowest: '最安値更新' } },
+    { key: 'price', title: '価格帯' },
+    { key: 'sub_category', title: 'サブカテゴリー' },
+    { key: 'tag', title: 'タグ', limit: 20 },
+];
+
+/**
+ * 昇順に並んだ2つの商品番号リストの共通部分を求める
+ * @param {Array<number>} a
+ * @param {Array<number>} b
+ * @returns {Array<number>}
+ */
+function intersectSorted(a, b) {
+    const result = [];
+    let i = 0;
+    let j = 0;
+    while (i < a.length && j < b.length) {
+        if (a[i] === b[j]) {
+            result.push(a[i]);
+            i++;
+            j++;
+        } else if (a[i] < b[j]) {
+            i++;
+        } else {
+            j++;
+        }
+    }
+    return result;
+}
+
+/**
+ * 昇順に並んだ2つの商品番号リストの和集合を求める
+ * @param {Array<number>} a
+ * @param {Array<number>} b
+ * @returns {Array<number>}
+ */
+function unionSorted(a, b) {
+    const result = [];
+    let i = 0;
+    let j = 0;
+    while (i < a.length || j < b.length) {
+        if (j >= b.length || (i < a.length && a[i] < b[j])) {
+            result.push(a[i++]);
+        } else if (i >= a.length || b[j] < a[i]) {
+            result.push(b[j++]);
+        } else {
+            result.push(a[i]);
+            i++;
+            j++;
+        }
+    }
+    return result;
+}
+
+/**
+ * 絞り込みパネルを描画し、チェックの変更に合わせて商品一覧を更新する
+ * @param {HTMLElement} container - パネルを表示するDOM要素
+ * @param {Object} facetIndex - facets/<カテゴリー>.json の内容
+ * @param {Array<number>} baseIds - このカテゴリーに属する商品番号
+ * @param {string} rootPath - サイトのルートへの相対パス
+ */
+function renderFacetFilter(container, facetIndex, baseIds, rootPath) {
+    const priceLabels = {};
+    facetIndex.price_buckets.forEach(bucket => { priceLabels[bucket.key] = bucket.label; });
+
+    let panelHtml = '';
+    FACET_GROUPS.forEach(group => {
+        const values = facetIndex.facets[group.key] || {};
+        // このカテゴリー内に該当商品がある値だけを、該当件数の多い順に表示する
+        let options = Object.keys(values)
+            .map(value => ({ value: value, count: intersectSorted(baseIds, values[value]).length }))
+            .filter(option => option.count > 0);
+        if (group.key === 'price') {
+            const order = facetIndex.price_buckets.map(bucket => bucket.key);
+            options.sort((a, b) => order.indexOf(a.value) - order.indexOf(b.value));
+        } else {
+            options.sort((a, b) => b.count - a.count);
+        }
+        if (group.limit) options = options.slice(0, group.limit);
+        if (options.length === 0) return;
+
+        const optionsHtml = options.map(option => {
+            let label = option.value;
+            if (group.labels) label = group.labels[option.value] || option.value;
+            if (group.key === 'price') label = priceLabels[option.value] || option.value;
+            if (group.key === 'sub_category') label = option.value.split('/').slice(1).join('/');
+            return `<label><input type="checkbox" data-group="${group.key}" value="${option.value}"> ${label} (${option.count})</label>`;
+        }).join('');
+        panelHtml += `
+            <div class="facet-group">
+                <div class="facet-group-title">${group.title}</div>
+                <div class="facet-options">${optionsHtml}</div>
+            </div>
+        `;
+    });
+    if (!panelHtml) return;
+
+    container.innerHTML = panelHtml + '<p class="facet-result-count"></p>';
+    const grid = container.parentElement.querySelector('.product-grid');
+    const countElement = container.querySelector('.facet-result-count');
+
+    container.addEventListener('change', () => {
+        // 同じグループ内はOR（和集合）、グループ間はAND（共通部分）で組み合わせる
+        const selected = {};
+        container.querySelectorAll('input[type="checkbox"]:checked').forEach(input => {
+            const group = input.getAttribute('data-group');
+            selected[group] = unionSorted(selected[group] || [], facetIndex.facets[group][input.value]);
+        });
+
+        let resultIds = baseIds;
+        Object.keys(selected).forEach(group => {
+            resultIds = intersectSorted(resultIds, selected[group]);
+        });
+
+        countElement.textContent = Object.keys(selected).length ? `${resultIds.length}件の商品が見つかりました` : '';
+        renderFacetResults(resultIds.map(id => facetIndex.docs[id]), grid, rootPath);
+    });
+}
+
+/**
+ * 絞り込み結果の商品カードを描画する
+ * @param {Array<Array>} docs - [page_url, name, price, image_url, ai_headline] の配列
+ * @param {HTMLElement} grid - 商品一覧のDOM要素
+ * @param {string} rootPath - サイトのルートへの相対パス
+ */
+function renderFacetResults(docs, grid, rootPath) {
+    if (docs.length === 0) {
+        grid.innerHTML = '<p class="col-span-full text-center text-gray-500 py-8 border border-dashed rounded-lg">条件に一致する商品は見つかりませんでした。</p>';
+        return;
+    }
+    grid.innerHTML = docs.map(([pageUrl, name, price, imageUrl, headline]) => `
+        <a href="${rootPath}${pageUrl}" class="product-card">
+            <img src="${imageUrl || ''}" alt="${name || '商品画像'}">
+            <div class="product-info">
+                <h3 class="product-name">${name.length > 20 ? name.substring(0, 20) + '...' : name}</h3>
+                <p class="product-price">${parseInt(String(price).replace(/,/g, '')).toLocaleString()}円</p>
+                <div class="price-status-title">💡注目ポイント</div>
+                <div class="price-status-content ai-analysis">${headline || 'AI分析準備中'}</div>
+            </div>
+        </a>
+    `).join('');
+}
@@ -1,12 +1,20 @@
 # -*- coding: utf-8 -*-
+import argparse
+import hashlib
+import heapq
+import importlib.util
 import json
 import math
 import os
-import shutil
+import re
+import sqlite3
+import tempfile
 import time
+import types
+from array import array
 from datetime import date
-import requests
 import csv
+import filecmp
 import urllib.parse
 from urllib.parse import urlparse
 
@@ -37,6 +45,50 @@ UTILITY_CATEGORIES = {
 
 # 1ページあたりの商品数を定義
 PRODUCTS_PER_PAGE = 24
+# タグ一覧ページ1ページあたりのタグ数
+TAGS_PER_PAGE = 50
+
+# 絞り込み用ファセットの価格帯 (下限, 上限, 表示名)。上限Noneは上限なし
+PRICE_BUCKETS = [
+    (0, 1000, "〜1,000円"),
+    (1000, 3000, "1,000〜3,000円"),
+    (3000, 5000, "3,000〜5,000円"),
+    (5000, 10000, "5,000〜10,000円"),
+    (10000, 30000, "1万〜3万円"),
+    (30000, 50000, "3万〜5万円"),
+    (50000, 100000, "5万〜10万円"),
+    (100000, None, "10万円〜"),
+]
+FACET_INDEX_FILE = 'facet_index.json'
+# カテゴリーページが読み込む、カテゴリーごとの絞り込みデータと商品カードのデータ
+FACET_CATEGORY_DIR = 'facets'
+# 検索インデックスのバージョン情報 (クライアントはこれが変わった時だけインデックスを再取得する)
+SEARCH_INDEX_FILE = 'search_index.json'
+SEARCH_INDEX_MANIFEST_FILE = 'search_index_version.json'
+
+# 商品詳細ページの類似商品レコメンドの設定
+SIMILAR_PRODUCTS_COUNT = 6
+SIMILARITY_TAG_WEIGHT = 3
+SIMILARITY_MAX_DF_RATIO = 0.5
+SIMILARITY_MIN_SCORE = 0.05
+SIMILARITY_BATCH_SIZE = 256
+# これを超える商品数では、重みの大きい語が同じ商品どうしのバケットで候補を絞る近似計算に切り替える
+EXACT_SIMILARITY_LIMIT = 5000
+SIMILARITY_BLOCK_TERMS = 8
+SIMILARITY_MAX_BUCKET_SIZE = 512
+
+# セール判定に使うタグ
+SALE_TAGS = ['セール', '期間限定', 'タイムセール', '特価']
+# このポイント倍率以上の商品をポイント高還元とみなす
+POINT_RATE_THRESHOLD = 2
+# お得情報ランキング (最安値・ポイント特化) の各一覧に載せる件数
+LEADERBOARD_SIZE = 24
+# 特別カテゴリー（動的お得情報）のページの見出しと説明文
+SPECIAL_PAGE_TEXTS = {
+    '最安値': ("最安値のお得な商品一覧", "値下がり率の大きい商品、過去最安値を更新した商品、カテゴリーごとの最安値の商品をまとめています。"),
+    '期間限定セール': ("🔥限定価格！今すぐ買いたいセール商品", "AIがタグや価格変動を分析し、現在セール中・タイムセール中の商品をリアルタイムでリストアップしています。"),
+    'ポイント特化': ("✨ポイント高還元商品", f"楽天市場のポイント倍率が{POINT_RATE_THRESHOLD}倍以上の商品を、倍率の高い順にピックアップしています。買い時を見逃さないでください！"),
+}
 
 # APIキーは実行環境が自動的に供給するため、ここでは空の文字列とします。
 # OpenAI APIの設定
@@ -44,61 +96,221 @@ OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 MODEL_NAME = "gpt-4o-mini"
 CACHE_FILE = 'products.csv'
-
-# AmazonとYahoo!ショッピングのアフィリエイトリンクを定義
+# fetchステージで取得した商品を、enrichステージに渡すための一時ファイル
+FETCHED_PRODUCTS_FILE = 'fetched_products.jsonl'
+
+# AI生成結果を1件ずつ追記するジャーナル (途中で落ちても完了分を再利用するため)
+ENRICHMENT_JOURNAL_FILE = 'enrichment_journal.jsonl'
+JOURNAL_FIELDS = ['ai_summary', 'tags', 'category', 'ai_headline', 'ai_analysis']
+
+# AIの応答キャッシュ (名前空間付きのキーバリューストア)
+AI_CACHE_DB = 'ai_cache.sqlite3'
+# キャッシュの上限件数と、最後に参照されてから保持する日数 (超えた分は参照の古い順に削除)
+AI_CACHE_MAX_ENTRIES = 50000
+AI_CACHE_MAX_AGE_DAYS = 180
+# 旧形式のJSONキャッシュと、移行先の名前空間・キーの接頭辞
+LEGACY_CACHE_FILES = {
+    'ai_cache.json': ('analysis_by_name', ''),
+    'ai_analysis_cache.json': ('analysis_by_id', ''),
+    'product_highlight_cache.json': ('highlight', 'highlight_'),
+    'subcategory_cache.json': ('subcategory', 'subcategory_'),
+}
+# 価格履歴は価格が変わったときだけ区間を追加し、古い区間は週ごと・月ごとの最安値/最高値にまとめる
+# (最後に観測した日からの経過日数がこれを超えた区間が対象)
+PRICE_HISTORY_WEEKLY_AFTER_DAYS = 90
+PRICE_HISTORY_MONTHLY_AFTER_DAYS = 365
+# 外部ソートで一度にメモリへ載せるレコード数
+SORT_CHUNK_SIZE = 10000
+# 分割ビルド (render --shard i/N) で各シャードが生成したページの一覧を書き出すディレクトリ
+BUILD_MANIFEST_DIR = 'build_manifest'
+# generate_site が生成するページのディレクトリ (生成後に、今回生成しなかった古いファイルを削除する対象)
+GENERATED_PAGE_DIRS = ['pages', 'category', 'tags']
+# serve --watch で監視する静的ファイルと、変更を確認する間隔 (秒)
+WATCHED_ASSETS = ['style.css', 'script.js', 'facet.js', 'search_worker.js', 'nav.js']
+WATCH_INTERVAL = 0.3
+# ページを書き出す関数と、その関数 (またはそこから呼ばれる関数) が変わったときに再生成するページの種類
+TEMPLATE_PAGE_KINDS = {
+    'render_pages': {'index', 'category', 'leaderboard', 'tag', 'tag_index'},
+    '_write_product_detail_page': {'detail'},
+    '_write_index_page': {'index'},
+    '_write_tag_index_pages': {'tag_index'},
+    '_write_tag_pages': {'tag'},
+    '_write_leaderboard_page': {'leaderboard'},
+    '_write_deal_leaderboard_pages': {'leaderboard'},
+    '_start_category_page': {'category'},
+    '_start_special_page': {'category'},
+    'generate_search_results_page': {'search_results'},
+    'generate_placeholder_page': {'placeholder'},
+}
+ALL_PAGE_KINDS = {'detail', 'index', 'category', 'leaderboard', 'tag', 'tag_index', 'search_results', 'placeholder'}
+# sitemap.xmlのlastmodを内容が変わったときだけ更新するため、ページごとの内容のハッシュと更新日を保存するファイル
+SITEMAP_LASTMOD_FILE = 'sitemap_lastmod.json'
+
+# 他のマーケットプレイスで同じ商品を探し、ショップごとの価格を比較する
+YAHOO_SHOPPING_API_URL = "https://shopping.yahooapis.jp/ShoppingWebService/V3/itemSearch"
+YAHOO_API_KEY = os.environ.get("YAHOO_API_KEY")
+# Yahoo!ショッピングAPIが返す商品URLをアフィリエイトリンクにするためのバリューコマースのID
+# (検索結果へのリンクは vc_url に遷移先を付けてこのリンク経由にする)
+YAHOO_AFFILIATE_ID = "http://ck.jp.ap.valuecommerce.com/servlet/referral?sid=3754088&pid=892109155"
+# Amazonアソシエイトのトラッキングタグ。未設定の場合は検索結果ではなく従来のアフィリエイトリンクを使う
+AMAZON_ASSOCIATE_TAG = os.environ.get("AMAZON_ASSOCIATE_TAG")
 AMAZON_AFFILIATE_LINK = "https://amzn.to/46zr68v"
-YAHOO_AFFILIATE_LINK = "//ck.jp.ap.valuecommerce.com/servlet/referral?sid=3754088&pid=892109155"
+MARKETPLACE_LABELS = {'rakuten': '楽天市場', 'yahoo': 'Yahoo!ショッピング', 'amazon': 'Amazon'}
+# 設定すると、各マーケットプレイスのAPIの代わりに <ディレクトリ>/<マーケットプレイス>.json の応答を使う (テスト用)
+MARKETPLACE_FIXTURE_DIR = os.environ.get("MARKETPLACE_FIXTURE_DIR")
+# まとめて問い合わせる商品数と、1商品あたりに保存するショップの数
+MARKETPLACE_BATCH_SIZE = 20
+# 1つのマーケットプレイスに同時に問い合わせる商品数
+MARKETPLACE_CONCURRENCY = 5
+MARKETPLACE_MAX_OFFERS = 5
+# 商品名の文字bigramのDice係数と価格比がこの範囲にあるものを同じ商品とみなす
+MARKETPLACE_MATCH_MIN_SIMILARITY = 0.4
+MARKETPLACE_MATCH_PRICE_RATIO = (0.5, 2.0)
 
 # CSVファイルのフィールド名を固定
 CSV_FIELDNAMES = [
     'id', 'name', 'price', 'image_url', 'rakuten_url', 'yahoo_url', 'amazon_url',
     'page_url', 'category', 'ai_headline', 'ai_analysis', 'description',
-    'ai_summary', 'tags', 'date', 'main_ec_site', 'price_history', 'source'
+    'ai_summary', 'tags', 'date', 'main_ec_site', 'price_history', 'source',
+    'point_rate', 'deal_signals', 'offers'
 ]
 
-def get_cached_data():
-    """CSVファイルからキャッシュされた商品データを読み込む"""
-    cached_data = {}
-    if os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                if 'id' not in reader.fieldnames:
-                    print("警告: CSVファイルに'id'ヘッダーが見つかりません。")
-                    return {}
-
-                for row in reader:
-                    if not row.get('id'):
-                        continue
-                    product_id = row['id']
-                    
-                    # JSON文字列として保存されているデータを正しくパース
-                    for key in ['price_history', 'tags', 'category']:
-                        if key in row and isinstance(row[key], str):
-                            try:
-                                row[key] = json.loads(row[key])
-                            except (json.JSONDecodeError, TypeError):
-                                print(f"警告: ID {product_id} の {key} パースに失敗しました。")
-                                row[key] = [] if key in ['price_history', 'tags'] else {"main": "不明", "sub": ""}
-                    
-                    # categoryが辞書形式でない場合に補完
-                    if 'category' in row and not isinstance(row['category'], dict):
-                        row['category'] = {"main": "不明", "sub": ""}
-                    
-                    cached_data[product_id] = row
-        except csv.Error as e:
-            print(f"CSVファイルの読み込み中にエラーが発生しました: {e}")
-            return {}
-    return cached_data
+def _history_price_range(entry):
+    """価格履歴の1区間の (最安値, 最高値) を返す"""
+    if 'price' in entry:
+        return entry['price'], entry['price']
+    return entry['min'], entry['max']
 
-def save_to_cache(products):
-    """商品データをCSVファイルに保存する"""
-    if not products:
-        if os.path.exists(CACHE_FILE):
-            os.remove(CACHE_FILE)
+def normalize_price_history(history):
+    """
+    価格履歴を変化点形式に揃える。各要素は {"from", "to", "price"} (その期間ずっと同じ価格) か、
+    古い区間をまとめた {"from", "to", "min", "max"} で、日付の昇順に並ぶ。
+    旧形式の日ごとの {"date", "price"} は、同じ価格が続く間を1つの区間にまとめる。
+    """
+    segments = []
+    for entry in history:
+        if not isinstance(entry, dict):
+            continue
+        if 'date' in entry:
+            price = parse_price(entry.get('price'))
+            if price is None:
+                continue
+            entry = {"from": entry['date'], "to": entry['date'], "price": price}
+        elif 'from' not in entry or 'to' not in entry:
+            continue
+        last = segments[-1] if segments else None
+        if last and 'price' in last and last['price'] == entry.get('price'):
+            last['to'] = max(last['to'], entry['to'])
+        else:
+            segments.append(dict(entry))
+    return segments
+
+def record_price(history, current_date, current_price):
+    """
+    今日の価格を価格履歴に記録する。前回と同じ価格なら最後の区間を延ばすだけで、要素は増えない。
+    前回の価格から変わった場合はTrueを返す。
+    """
+    last = history[-1] if history else None
+    if last and last['from'] == current_date and 'price' in last and last['price'] != current_price:
+        # 同じ日に再実行して価格が変わっていた場合は、その日の区間を置き換える
+        history.pop()
+        last = history[-1] if history else None
+    if last and last.get('price') == current_price:
+        last['to'] = max(last['to'], current_date)
+        return False
+    history.append({"from": current_date, "to": current_date, "price": current_price})
+    return last is not None
+
+def compact_price_history(history, today, weekly_after_days=PRICE_HISTORY_WEEKLY_AFTER_DAYS, monthly_after_days=PRICE_HISTORY_MONTHLY_AFTER_DAYS):
+    """古い区間を、開始日の週 (または月) ごとに最安値・最高値の区間へまとめる"""
+    today_date = date.fromisoformat(today)
+    compacted = []
+    for entry in history:
+        age = (today_date - date.fromisoformat(entry['to'])).days
+        if age > monthly_after_days:
+            period = entry['from'][:7]
+        elif age > weekly_after_days:
+            iso_year, iso_week, _ = date.fromisoformat(entry['from']).isocalendar()
+            period = f"{iso_year}-W{iso_week:02d}"
+        else:
+            period = None
+        if period and compacted and compacted[-1][0] == period:
+            merged = compacted[-1][1]
+            low, high = _history_price_range(entry)
+            merged_low, merged_high = _history_price_range(merged)
+            compacted[-1][1] = {"from": merged['from'], "to": entry['to'], "min": min(low, merged_low), "max": max(high, merged_high)}
+        else:
+            compacted.append([period, entry])
+    return [entry for _period, entry in compacted]
+
+def price_change_points(history):
+    """
+    価格履歴を、価格が変わった日ごとの {"date", "price"} の系列にする (グラフ表示用)。
+    まとめた区間はその期間の最安値で表す。最後の価格を今日まで延ばすのはグラフのスクリプト側で行うので、
+    価格が変わらない限り系列 (とそれを埋め込んだページ) は実行日によらず同じになる。
+    """
+    points = []
+    for entry in history:
+        low, _high = _history_price_range(entry)
+        if points and points[-1]['price'] == low:
+            continue
+        points.append({"date": entry['from'], "price": low})
+    return points
+
+def _parse_cached_row(row):
+    """CSVの1行を商品データの辞書に変換する"""
+    product_id = row['id']
+
+    # JSON文字列として保存されているデータを正しくパース
+    for key in ['price_history', 'tags', 'category', 'deal_signals', 'offers']:
+        if key in row and isinstance(row[key], str):
+            try:
+                row[key] = json.loads(row[key])
+            except (json.JSONDecodeError, TypeError):
+                if key == 'offers' and not row[key]:
+                    # 比較データを保存する前のCSVでは空欄になっている
+                    row[key] = []
+                    continue
+                print(f"警告: ID {product_id} の {key} パースに失敗しました。")
+                if key in ['price_history', 'tags', 'offers']:
+                    row[key] = []
+                elif key == 'deal_signals':
+                    row[key] = {}
+                else:
+                    row[key] = {"main": "不明", "sub": ""}
+
+    # categoryが辞書形式でない場合に補完
+    if 'category' in row and not isinstance(row['category'], dict):
+        row['category'] = {"main": "不明", "sub": ""}
+    # 旧形式 (日ごと) の価格履歴は読み込み時に変化点形式へ変換する
+    if isinstance(row.get('price_history'), list):
+        row['price_history'] = normalize_price_history(row['price_history'])
+    return row
+
+def iter_cached_products():
+    """CSVファイルから商品データを1件ずつ読み込む (全件をメモリに載せない)"""
+    if not os.path.exists(CACHE_FILE):
         return
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            if 'id' not in reader.fieldnames:
+                print("警告: CSVファイルに'id'ヘッダーが見つかりません。")
+                return
+
+            for row in reader:
+                if not row.get('id'):
+                    continue
+                yield _parse_cached_row(row)
+    except csv.Error as e:
+        print(f"CSVファイルの読み込み中にエラーが発生しました: {e}")
 
-    with open(CACHE_FILE, 'w', encoding='utf-8', newline='') as f:
+def save_to_cache(products):
+    """商品データを1件ずつCSVファイルに保存し、保存件数を返す"""
+    # 書き込み途中で落ちても既存のCSVを壊さないよう、一時ファイルに書いてから置き換える
+    tmp_path = CACHE_FILE + '.tmp'
+    count = 0
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
         writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES)
         writer.writeheader()
         for product in products:
@@ -107,30 +319,274 @@ def save_to_cache(products):
             product_to_write['price_history'] = json.dumps(product_to_write.get('price_history', []), ensure_ascii=False)
             product_to_write['tags'] = json.dumps(product_to_write.get('tags', []), ensure_ascii=False)
             product_to_write['category'] = json.dumps(product_to_write.get('category', {"main": "不明", "sub": ""}), ensure_ascii=False)
+            product_to_write['deal_signals'] = json.dumps(product_to_write.get('deal_signals', {}), ensure_ascii=False)
+            product_to_write['offers'] = json.dumps(product_to_write.get('offers', []), ensure_ascii=False)
             writer.writerow(product_to_write)
+            count += 1
+
+    if not count:
+        os.remove(tmp_path)
+        if os.path.exists(CACHE_FILE):
+            os.remove(CACHE_FILE)
+        return 0
+
+    os.replace(tmp_path, CACHE_FILE)
+    return count
+
+def _write_sorted_run(chunk, key, reverse):
+    """ソート済みのチャンクを一時ファイル (JSON Lines) に書き出す"""
+    chunk.sort(key=key, reverse=reverse)
+    run_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+    for item in chunk:
+        run_file.write(json.dumps(item, ensure_ascii=False) + '\n')
+    run_file.seek(0)
+    return run_file
+
+def _read_run(run_file):
+    """一時ファイルに書き出したレコードを1件ずつ読み出す"""
+    for line in run_file:
+        yield json.loads(line)
+
+def external_sort(items, key, reverse=False, chunk_size=SORT_CHUNK_SIZE):
+    """
+    大量のレコードをメモリに載せずに並べ替える。
+    chunk_size件ごとにソートして一時ファイルに書き出し、最後にマージしながら順に返す。
+    """
+    run_files = []
+    chunk = []
+    try:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                run_files.append(_write_sorted_run(chunk, key, reverse))
+                chunk = []
+
+        if not run_files:
+            # 全件がチャンクに収まる場合は一時ファイルを使わない
+            chunk.sort(key=key, reverse=reverse)
+            yield from chunk
+            return
+
+        if chunk:
+            run_files.append(_write_sorted_run(chunk, key, reverse))
+        yield from heapq.merge(*[_read_run(f) for f in run_files], key=key, reverse=reverse)
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+def spool_to_disk(items):
+    """レコードを一時ファイルに書き出し、(ファイル, 件数) を返す。複数回の走査に使う"""
+    spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+    count = 0
+    for item in items:
+        spool.write(json.dumps(item, ensure_ascii=False) + '\n')
+        count += 1
+    return spool, count
+
+def iter_spool(spool):
+    """spool_to_diskで書き出したレコードを先頭から1件ずつ読み出す"""
+    spool.seek(0)
+    yield from _read_run(spool)
+
+def load_enrichment_journal():
+    """中断した前回実行のジャーナルを読み込み、完了済みのAI生成結果をIDごとに返す"""
+    journal = {}
+    if not os.path.exists(ENRICHMENT_JOURNAL_FILE):
+        return journal
+
+    with open(ENRICHMENT_JOURNAL_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中でクラッシュした末尾の行は読み飛ばす
+                print("警告: ジャーナルの不完全な行をスキップしました。")
+                continue
+            if entry.get('id'):
+                journal[entry['id']] = entry
+
+    if journal:
+        print(f"ジャーナルから {len(journal)} 件の完了済みAI生成結果を復元します。")
+    return journal
+
+def append_enrichment_journal(journal_file, product, current_price):
+    """1商品分のAI生成結果をジャーナルに追記し、即座にディスクへ書き出す"""
+    entry = {"id": product['id'], "price": current_price}
+    for key in JOURNAL_FIELDS:
+        entry[key] = product.get(key)
+    journal_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+
+def _apply_journal_entry(product, entry, current_price):
+    """ジャーナルの結果が現在の価格と一致する場合のみ商品に反映する"""
+    if not entry or entry.get('price') != current_price:
+        return False
+    for key in JOURNAL_FIELDS:
+        if entry.get(key) is not None:
+            product[key] = entry[key]
+    print(f"商品 '{product['name']}' はジャーナルに完了済みの結果があるため、AI生成をスキップしました。")
+    return True
+
+# 開いているキャッシュの接続と、名前空間ごとの [ヒット数, ミス数]
+_ai_cache_connection = None
+_ai_cache_stats = {}
+# 今回の実行で参照したエントリー (参照日時は閉じるときにまとめて更新する)
+_ai_cache_accessed = set()
+
+def _cache_timestamp():
+    """
+    キャッシュの作成・参照日時 (日単位に丸める)。参照日時は削除の判定にだけ使うので、
+    同じ日に何度参照しても更新は1回で済む。DBはリポジトリにコミットせず、Actionsのキャッシュで引き継ぐ。
+    """
+    return time.time() // 86400 * 86400
+
+def _migrate_legacy_caches(connection):
+    """旧形式のJSONキャッシュの内容をキャッシュDBに取り込む (内容が変わったファイルのみ)"""
+    for file_name, (namespace, key_prefix) in LEGACY_CACHE_FILES.items():
+        if not os.path.exists(file_name):
+            continue
+        with open(file_name, 'rb') as f:
+            content = f.read()
+        content_hash = hashlib.sha256(content).hexdigest()
+        row = connection.execute("SELECT value FROM meta WHERE key = ?", (f"migrated:{file_name}",)).fetchone()
+        if row and row[0] == content_hash:
+            continue
+        try:
+            entries = json.loads(content.decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            print(f"警告: {file_name} の読み込みに失敗したため、移行をスキップしました: {e}")
+            continue
+        now = _cache_timestamp()
+        # 既にキャッシュにあるエントリーの方が新しいので、上書きはしない
+        connection.executemany(
+            "INSERT OR IGNORE INTO cache (namespace, key, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            [
+                (namespace, key[len(key_prefix):] if key.startswith(key_prefix) else key, json.dumps(value, ensure_ascii=False), now, now)
+                for key, value in entries.items()
+            ]
+        )
+        connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"migrated:{file_name}", content_hash))
+        connection.commit()
+        print(f"{file_name} の {len(entries)} 件を名前空間 '{namespace}' に移行しました。")
+
+def _get_ai_cache():
+    """キャッシュDBを初回の参照時に開く"""
+    global _ai_cache_connection
+    if _ai_cache_connection is None:
+        _ai_cache_connection = sqlite3.connect(AI_CACHE_DB)
+        _ai_cache_connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+        _ai_cache_connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        _ai_cache_connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        _migrate_legacy_caches(_ai_cache_connection)
+    return _ai_cache_connection
+
+def cache_get(namespace, key):
+    """キャッシュから1件だけ読み込む。見つからなければNoneを返す"""
+    connection = _get_ai_cache()
+    row = connection.execute("SELECT value FROM cache WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+    stats = _ai_cache_stats.setdefault(namespace, [0, 0])
+    if row is None:
+        stats[1] += 1
+        return None
+    stats[0] += 1
+    _ai_cache_accessed.add((namespace, key))
+    return json.loads(row[0])
+
+def _flush_cache_access(connection):
+    """今回参照したエントリーの参照日時を、まとめて今日の日付に更新する"""
+    now = _cache_timestamp()
+    connection.executemany(
+        "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ? AND accessed_at < ?",
+        [(now, namespace, key, now) for namespace, key in _ai_cache_accessed]
+    )
+    connection.commit()
+    _ai_cache_accessed.clear()
+
+def cache_put(namespace, key, value):
+    """キャッシュに1件書き込み、即座にディスクへ反映する"""
+    connection = _get_ai_cache()
+    now = _cache_timestamp()
+    connection.execute(
+        "INSERT OR REPLACE INTO cache (namespace, key, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+        (namespace, key, json.dumps(value, ensure_ascii=False), now, now)
+    )
+    connection.commit()
+
+def evict_ai_cache(max_entries=AI_CACHE_MAX_ENTRIES, max_age_days=AI_CACHE_MAX_AGE_DAYS):
+    """長い間参照されていないエントリーと、上限件数を超えた分を参照の古い順に削除する"""
+    connection = _get_ai_cache()
+    # 今回参照したエントリーを削除しないよう、先に参照日時を反映する
+    _flush_cache_access(connection)
+    removed_count = connection.execute(
+        "DELETE FROM cache WHERE accessed_at < ?", (_cache_timestamp() - max_age_days * 86400,)
+    ).rowcount
+    removed_count += connection.execute(
+        "DELETE FROM cache WHERE (namespace, key) IN "
+        "(SELECT namespace, key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+        (max_entries,)
+    ).rowcount
+    connection.commit()
+    if removed_count:
+        print(f"AIキャッシュから {removed_count} 件の古いエントリーを削除しました。")
+    return removed_count
+
+def close_ai_cache():
+    """キャッシュのヒット率を表示し、参照日時の更新を書き出して閉じる"""
+    global _ai_cache_connection
+    if _ai_cache_connection is None:
+        return
+    for namespace, (hits, misses) in sorted(_ai_cache_stats.items()):
+        print(f"AIキャッシュ '{namespace}': ヒット {hits} 件 / ミス {misses} 件 (ヒット率 {hits / (hits + misses):.1%})")
+    _flush_cache_access(_ai_cache_connection)
+    _ai_cache_connection.close()
+    _ai_cache_connection = None
+    _ai_cache_stats.clear()
+
+def _call_openai_api(prompt, response_format, required_keys=()):
+    """
+    OpenAI APIを呼び出す共通関数。同じリクエストの応答はキャッシュから返す。
+    required_keysのキーがすべて空でない値で揃った応答だけをキャッシュする (欠けた応答は次回の実行で取り直す)。
+    """
+    payload = {
+        "model": MODEL_NAME,
+        "messages": [{"role": "system", "content": "あなたはプロのAIアシスタントです。"}, {"role": "user", "content": prompt}],
+        "response_format": {"type": response_format}
+    }
+    cache_key = hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+    cached = cache_get('openai', cache_key)
+    if cached is not None:
+        return cached
 
-def _call_openai_api(prompt, response_format):
-    """OpenAI APIを呼び出す共通関数"""
     if not OPENAI_API_KEY:
         print("警告: OpenAI APIキーが設定されていません。")
         return None
 
+    # ネットワーク系のライブラリは、実際に通信するステージでのみ読み込む
+    import requests
+
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {OPENAI_API_KEY}'
     }
 
-    payload = {
-        "model": MODEL_NAME,
-        "messages": [{"role": "system", "content": "あなたはプロのAIアシスタントです。"}, {"role": "user", "content": prompt}],
-        "response_format": {"type": response_format}
-    }
-
     try:
         response = requests.post(OPENAI_API_URL, headers=headers, data=json.dumps(payload), timeout=20)
         response.raise_for_status()
         result = response.json()
-        return json.loads(result.get('choices', [{}])[0].get('message', {}).get('content', '{}'))
+        content = json.loads(result.get('choices', [{}])[0].get('message', {}).get('content', '{}'))
+        if isinstance(content, dict) and all(content.get(key) for key in required_keys):
+            cache_put('openai', cache_key, content)
+        else:
+            print("OpenAI APIの応答に必要な項目が揃っていないため、キャッシュしません。")
+        return content
     except requests.exceptions.Timeout:
         print("OpenAI APIへのリクエストがタイムアウトしました。")
     except requests.exceptions.RequestException as e:
@@ -160,7 +616,7 @@ def map_to_defined_category(sub_category, product_name):
     # いずれにも当てはまらない場合、対象外とする
     return 'その他', 'その他'
 
-def generate_ai_metadata(product_name, product_description):
+def generate_ai_metadata(product_name, product_description, item_id=None):
     """商品の要約、タグ、サブカテゴリーを生成する"""
     prompt = f"""
     以下の商品情報をもとに、ウェブサイトのコンテンツとして最適な、簡潔で魅力的な要約、関連するタグ（3〜5個）、そして適切なサブカテゴリー（1つ）を日本語で生成してください。
@@ -173,39 +629,49 @@ def generate_ai_metadata(product_name, product_description):
     タグは商品の特徴や用途を表す単語をリスト形式で生成してください。**セール中やポイント還元率が高い場合は「セール」や「ポイント高還元」といったタグを必ず含めてください。**
     サブカテゴリーは、商品のジャンルを細分化した単一の単語を生成してください。
     """
-    metadata = _call_openai_api(prompt, "json_object")
+    metadata = _call_openai_api(prompt, "json_object", required_keys=('summary', 'tags', 'sub_category'))
     if metadata:
         ai_sub_category = metadata.get('sub_category', "")
         main_cat, sub_cat = map_to_defined_category(ai_sub_category, product_name)
         return metadata.get('summary', "この商品の詳しい説明は準備中です。"), metadata.get('tags', []), main_cat, sub_cat
     
-    # AIが失敗した場合も、商品名からカテゴリーを推測
-    main_cat, sub_cat = map_to_defined_category("", product_name)
+    # AIが失敗した場合も、旧形式のキャッシュのサブカテゴリーか商品名からカテゴリーを推測
+    legacy_sub_category = cache_get('subcategory', item_id) if item_id else None
+    main_cat, sub_cat = map_to_defined_category(legacy_sub_category or "", product_name)
     return "この商品の詳しい説明は準備中です。", [], main_cat, sub_cat
 
-def generate_ai_analysis(product_name, product_price, price_history):
+def generate_ai_analysis(product_name, product_price, price_history, item_id=None):
     """商品の価格分析テキストを生成する"""
+    # 旧形式のキャッシュに同じ商品・同じ価格の分析があれば、APIを呼ばずにそれを使う
+    legacy_analysis = cache_get('analysis_by_id', f"{item_id}_{product_price:,}") if item_id else None
+    if legacy_analysis is None:
+        legacy_analysis = cache_get('analysis_by_name', f"{product_name}-{product_price}")
+    if legacy_analysis:
+        return legacy_analysis.get('headline', 'AI分析準備中'), legacy_analysis.get('details', '詳細なAI分析は現在準備中です。')
+
     history_text = f"過去の価格履歴は以下の通りです: {price_history}" if price_history else "価格履歴はありません。"
     prompt = f"""
     あなたは、価格比較の専門家として、消費者に商品の買い時をアドバイスします。回答は必ずJSON形式で提供してください。JSONは「headline」と「analysis」の2つのキーを持ちます。「headline」は商品の買い時を伝える簡潔な一言で、可能であれば具体的な割引率や数字を使って表現してください。「analysis」はなぜ買い時なのかを説明する詳細な文章です。日本語で回答してください。
     {product_name}という商品の現在の価格は{product_price}円です。{history_text}。この商品の価格について、市場の動向を踏まえた分析と買い時に関するアドバイスを日本語で提供してください。特に価格が前回と比べて下がっている場合は、**「最安値」**や**「セール」**といったキーワードを使って買い時を強調してください。
     **ポイント還元率が高い場合、その情報を「headline」に含めて強調してください。**
     """
-    analysis_data = _call_openai_api(prompt, "json_object")
+    analysis_data = _call_openai_api(prompt, "json_object", required_keys=('headline', 'analysis'))
     if analysis_data:
         return analysis_data.get('headline', 'AI分析準備中'), analysis_data.get('analysis', '詳細なAI分析は現在準備中です。')
     return "AI分析準備中", "詳細なAI分析は現在準備中です。"
 
 def fetch_rakuten_items():
-    """楽天APIから複数の商品データを取得する関数"""
+    """楽天APIから複数の商品データを取得し、1件ずつ返すジェネレーター"""
     app_id = os.environ.get('RAKUTEN_API_KEY')
     if not app_id:
         print("RAKUTEN_API_KEYが設定されていません。")
-        return []
+        return
+
+    import requests
 
     # 事前定義したカテゴリーに合わせてキーワードを調整
     keywords = ['ノートパソコン', '冷蔵庫', 'ダイエットサプリ', 'マッサージ機'] # キーワードを更新
-    all_products = []
+    total_count = 0
 
     for keyword in keywords:
         url = f"https://app.rakuten.co.jp/services/api/IchibaItem/Search/20170706?applicationId={app_id}&keyword={keyword}&format=json&sort=-reviewCount&hits=1"
@@ -228,9 +694,9 @@ def fetch_rakuten_items():
                         "price": str(item_data['itemPrice']),
                         "image_url": item_data.get('mediumImageUrls', [{}])[0].get('imageUrl', ''),
                         "rakuten_url": item_data.get('itemUrl', ''),
-                        # 修正後のYahoo!アフィリエイトリンクを割り当て
-                        "yahoo_url": YAHOO_AFFILIATE_LINK,
-                        "amazon_url": AMAZON_AFFILIATE_LINK,
+                        # 他のマーケットプレイスは、比較データが見つかるまで商品名の検索結果へのリンクにしておく
+                        "yahoo_url": _marketplace_search_url('yahoo', item_data['itemName']),
+                        "amazon_url": _marketplace_search_url('amazon', item_data['itemName']),
                         "page_url": f"pages/{item_data['itemCode'].replace(':', '_')}.html",
                         "category": {"main": "", "sub": ""},
                         "ai_headline": "",
@@ -242,100 +708,376 @@ def fetch_rakuten_items():
                         "main_ec_site": "楽天",
                         "price_history": [],
                         'source': 'rakuten',
+                        # 楽天のポイント倍率 (通常は1倍)
+                        "point_rate": item_data.get('pointRate', 1),
+                        # 他のマーケットプレイスで見つかった同じ商品 (attach_marketplace_offers で追加)
+                        "offers": [],
                     }
-                    all_products.append(new_product)
+                    total_count += 1
+                    yield new_product
         except requests.exceptions.RequestException as e:
             print(f"楽天APIへのリクエスト中にエラーが発生しました: {e}")
         except (IndexError, KeyError) as e:
             print(f"楽天APIの応答形式が不正です: {e}")
 
-    print(f"合計 {len(all_products)} 件の商品を取得しました。")
-    return all_products
+    print(f"合計 {total_count} 件の商品を取得しました。")
+
+def _marketplace_query(product_name):
+    """他のマーケットプレイスで検索するためのキーワードを商品名から作る (宣伝文句の括弧書きを除いた先頭の語)"""
+    name = re.sub(r'[【［\[<＜(（＼][^】］\]>＞)）／]*[】］\]>＞)）／]', ' ', product_name)
+    return ' '.join(name.split()[:6])
+
+def _marketplace_search_url(source, product_name):
+    """比較データがない場合に表示する、マーケットプレイスの検索結果へのアフィリエイトリンク"""
+    query = urllib.parse.quote(_marketplace_query(product_name))
+    if source == 'yahoo':
+        search_url = f"https://shopping.yahoo.co.jp/search?p={query}"
+        return f"{YAHOO_AFFILIATE_ID}&vc_url={urllib.parse.quote(search_url, safe='')}"
+    if not AMAZON_ASSOCIATE_TAG:
+        return AMAZON_AFFILIATE_LINK
+    return f"https://www.amazon.co.jp/s?k={query}&tag={urllib.parse.quote(AMAZON_ASSOCIATE_TAG)}"
+
+def _name_bigrams(name):
+    text = re.sub(r'\s+', '', name.lower())
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def _is_same_product(product, offer_name, offer_price):
+    """商品名の類似度と価格の近さから、他のマーケットプレイスの商品が同じものかどうかを判定する"""
+    price = parse_price(product.get('price'))
+    if not price or not offer_price:
+        return False
+    low, high = MARKETPLACE_MATCH_PRICE_RATIO
+    if not low <= offer_price / price <= high:
+        return False
+    product_bigrams = _name_bigrams(product.get('name', ''))
+    offer_bigrams = _name_bigrams(offer_name)
+    if not product_bigrams or not offer_bigrams:
+        return False
+    dice = 2 * len(product_bigrams & offer_bigrams) / (len(product_bigrams) + len(offer_bigrams))
+    return dice >= MARKETPLACE_MATCH_MIN_SIMILARITY
+
+# 読み込み済みのテスト用の応答 (マーケットプレイスごと)
+_marketplace_fixtures = {}
+
+def _load_marketplace_fixture(source):
+    """テスト用の応答 (商品IDごとのAPIの応答) を、マーケットプレイスごとに一度だけ読み込む"""
+    if source not in _marketplace_fixtures:
+        fixture_path = os.path.join(MARKETPLACE_FIXTURE_DIR, f"{source}.json")
+        fixture = {}
+        if os.path.exists(fixture_path):
+            with open(fixture_path, 'r', encoding='utf-8') as f:
+                fixture = json.load(f)
+        _marketplace_fixtures[source] = fixture
+    return _marketplace_fixtures[source]
+
+def search_yahoo_offers(product, timeout):
+    """Yahoo!ショッピングで同じ商品を検索し、ショップごとの価格を返す"""
+    if MARKETPLACE_FIXTURE_DIR:
+        data = _load_marketplace_fixture('yahoo').get(product['id'], {})
+    else:
+        if not YAHOO_API_KEY:
+            return []
+        import requests
+        params = {
+            "appid": YAHOO_API_KEY,
+            "query": _marketplace_query(product['name']),
+            "results": 20,
+            "sort": "+price",
+            "affiliate_type": "vc",
+            "affiliate_id": YAHOO_AFFILIATE_ID,
+        }
+        response = requests.get(YAHOO_SHOPPING_API_URL, params=params, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+
+    offers = []
+    for hit in data.get('hits', []):
+        offer_price = parse_price(hit.get('price'))
+        if _is_same_product(product, hit.get('name', ''), offer_price):
+            offers.append({
+                "source": "yahoo",
+                "shop": hit.get('seller', {}).get('name', ''),
+                "name": hit.get('name', ''),
+                "price": offer_price,
+                "url": hit.get('url', ''),
+            })
+    return offers
 
-def update_products_csv(new_products):
-    """新しい商品データを既存のproducts.csvに統合・更新する関数"""
-    cached_products = get_cached_data()
-    updated_products = {}
-
-    for item_id, product in cached_products.items():
-        if 'source' not in product:
-            product['source'] = 'rakuten'
-        updated_products[item_id] = product
-
-    final_products_to_save = []
-    for product in new_products:
-        item_id = product['id']
-        is_new = item_id not in updated_products
-        is_price_changed = False
-        current_date = date.today().isoformat()
+# マーケットプレイスごとの (検索関数 (商品, タイムアウト秒数) -> ショップごとの価格のリスト, 1リクエストのタイムアウト秒数,
+# 1バッチ分の検索の制限時間 (秒))。新しいマーケットプレイスは、同じ形の関数を作ってここに追加する
+MARKETPLACE_ADAPTERS = {
+    'yahoo': (search_yahoo_offers, 10, 20),
+}
+
+def _collect_marketplace_results(source, futures, deadline):
+    """
+    1つのマーケットプレイスの検索結果を、制限時間 (time.monotonic() の値) まで待って集める。
+    エラーになった商品と、制限時間までに終わらなかった商品は、比較データなしとして扱う。
+    """
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+
+    label = MARKETPLACE_LABELS.get(source, source)
+    results = []
+    timed_out_count = 0
+    for product, future in futures:
         try:
-            current_price = int(str(product['price']).replace(',', ''))
-        except (ValueError, KeyError):
-            print(f"価格の変換に失敗しました: {product.get('price', '不明')}")
+            results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+        except FutureTimeoutError:
+            future.cancel()
+            timed_out_count += 1
+            results.append([])
+        except Exception as e:
+            print(f"{label} での '{product['name'][:20]}' の検索に失敗しました: {e}")
+            results.append([])
+    if timed_out_count:
+        print(f"{label} の検索が制限時間内に終わらなかったため、{timed_out_count} 件の商品の比較をスキップしました。")
+    return results
+
+def attach_marketplace_offers(products):
+    """
+    商品を MARKETPLACE_BATCH_SIZE 件ずつ、すべてのマーケットプレイスで同時に検索し、
+    同じ商品と判定したショップの価格 (安い順に最大 MARKETPLACE_MAX_OFFERS 件) を 'offers' に付けて返す。
+    マーケットプレイスごとに最大 MARKETPLACE_CONCURRENCY 件ずつ並行に問い合わせ、バッチごとの制限時間で打ち切るので、
+    遅いマーケットプレイスを追加しても全体の時間は制限時間の分しか増えない。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def flush(executors, batch):
+        started_at = time.monotonic()
+        futures = {
+            source: [(product, executors[source].submit(search, product, timeout)) for product in batch]
+            for source, (search, timeout, _deadline) in MARKETPLACE_ADAPTERS.items()
+        }
+        results = {
+            source: _collect_marketplace_results(source, futures[source], started_at + MARKETPLACE_ADAPTERS[source][2])
+            for source in MARKETPLACE_ADAPTERS
+        }
+        for i, product in enumerate(batch):
+            best_offers = {}
+            for source in MARKETPLACE_ADAPTERS:
+                for offer in results[source][i]:
+                    shop_key = (offer['source'], offer['shop'])
+                    if shop_key not in best_offers or offer['price'] < best_offers[shop_key]['price']:
+                        best_offers[shop_key] = offer
+            offers = sorted(best_offers.values(), key=lambda o: (o['price'], o['source'], o['shop']))[:MARKETPLACE_MAX_OFFERS]
+            product['offers'] = offers
+            # マーケットプレイスごとの最安のショップへのリンクを商品のリンクにする (高い順に上書きする)
+            for offer in reversed(offers):
+                if f"{offer['source']}_url" in product:
+                    product[f"{offer['source']}_url"] = offer['url']
+            yield product
+
+    # マーケットプレイスごとにスレッドを分け、応答しないマーケットプレイスが他の検索を待たせないようにする
+    executors = {source: ThreadPoolExecutor(max_workers=MARKETPLACE_CONCURRENCY) for source in MARKETPLACE_ADAPTERS}
+    try:
+        batch = []
+        for product in products:
+            batch.append(product)
+            if len(batch) == MARKETPLACE_BATCH_SIZE:
+                yield from flush(executors, batch)
+                batch = []
+        if batch:
+            yield from flush(executors, batch)
+    finally:
+        # 制限時間を過ぎて残っている検索は待たない
+        for executor in executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def _merge_with_cache(fetched_products, cached_products):
+    """
+    IDでソート済みの取得商品とキャッシュ商品を突き合わせ、(取得商品, 既存商品またはNone) を順に返す。
+    両方をIDの昇順で1件ずつ進めるため、全件を辞書に載せる必要がない。
+    """
+    cached_iter = iter(cached_products)
+    cached = next(cached_iter, None)
+    last_id = None
+    for product in fetched_products:
+        # 複数のキーワードで同じ商品が取得された場合は最初の1件のみ扱う
+        if product['id'] == last_id:
             continue
+        last_id = product['id']
+        while cached is not None and cached['id'] < product['id']:
+            cached = next(cached_iter, None)
+        if cached is not None and cached['id'] == product['id']:
+            yield product, cached
+        else:
+            yield product, None
 
-        product['source'] = 'rakuten'
+def _enrich_product(product, existing_product, journal, journal_file):
+    """1商品分の価格履歴を更新し、必要なAI生成を行う。保存対象の商品を返す"""
+    item_id = product['id']
+    current_date = date.today().isoformat()
+    try:
+        current_price = int(str(product['price']).replace(',', ''))
+    except (ValueError, KeyError):
+        print(f"価格の変換に失敗しました: {product.get('price', '不明')}")
+        return None
 
-        if is_new:
-            # 新規商品の処理
-            product['price_history'] = [{"date": current_date, "price": current_price}]
-            print(f"新規商品 '{product['name']}' を追加します。AIデータを生成します。")
-            ai_summary, tags, main_cat, sub_cat = generate_ai_metadata(product['name'], product['description'])
-            
-            # 定義済みカテゴリーにない場合は「その他」として追加
-            if main_cat == 'その他':
-                print(f"商品 '{product['name']}' は定義済みカテゴリーに属さないため、カテゴリーを「その他」に設定します。")
-            
-            product['ai_summary'] = ai_summary
-            product['tags'] = tags
-            product['category']['main'] = main_cat
-            product['category']['sub'] = sub_cat
-            
-            ai_headline, ai_analysis_text = generate_ai_analysis(product['name'], current_price, product['price_history'])
-            product['ai_headline'] = ai_headline
-            product['ai_analysis'] = ai_analysis_text
-            final_products_to_save.append(product)
+    product['source'] = 'rakuten'
+
+    if existing_product is None:
+        # 新規商品の処理
+        product['price_history'] = []
+        record_price(product['price_history'], current_date, current_price)
+        if _apply_journal_entry(product, journal.get(item_id), current_price):
+            return product
+
+        print(f"新規商品 '{product['name']}' を追加します。AIデータを生成します。")
+        ai_summary, tags, main_cat, sub_cat = generate_ai_metadata(product['name'], product['description'], item_id)
+
+        # 定義済みカテゴリーにない場合は「その他」として追加
+        if main_cat == 'その他':
+            print(f"商品 '{product['name']}' は定義済みカテゴリーに属さないため、カテゴリーを「その他」に設定します。")
+
+        product['ai_summary'] = ai_summary
+        product['tags'] = tags
+        product['category']['main'] = main_cat
+        product['category']['sub'] = sub_cat
+
+        ai_headline, ai_analysis_text = generate_ai_analysis(product['name'], current_price, product['price_history'], item_id)
+        product['ai_headline'] = ai_headline
+        product['ai_analysis'] = ai_analysis_text
+        append_enrichment_journal(journal_file, product, current_price)
+        return product
+
+    # 既存商品の処理
+    if 'source' not in existing_product:
+        existing_product['source'] = 'rakuten'
+    price_history = existing_product.get('price_history', [])
+
+    # 価格が変わった日だけ区間が増え、古い区間は週・月ごとにまとめる
+    is_price_changed = record_price(price_history, current_date, current_price)
+    price_history = compact_price_history(price_history, current_date)
+
+    existing_product['price_history'] = price_history
+    existing_product['price'] = str(current_price)
+    existing_product['point_rate'] = product.get('point_rate', existing_product.get('point_rate', 1))
+    # 他のマーケットプレイスの価格は毎回取得し直したものに置き換える
+    existing_product['offers'] = product.get('offers', [])
+    # リンクは同じ商品が見つかった場合だけ、そのショップへのリンクに置き換える (リンクがなければ検索結果へのリンクを入れる)
+    for source in ['yahoo', 'amazon']:
+        key = f"{source}_url"
+        has_offer = any(offer['source'] == source for offer in existing_product['offers'])
+        if product.get(key) and (has_offer or not existing_product.get(key)):
+            existing_product[key] = product[key]
+
+    if _apply_journal_entry(existing_product, journal.get(item_id), current_price):
+        return existing_product
+
+    is_enriched = False
+    # 足りないのがサブカテゴリーだけで、旧形式のキャッシュにあればAPIを呼ばずに補う
+    legacy_sub_category = None
+    if existing_product.get('ai_summary') and existing_product.get('tags') and not existing_product['category'].get('sub'):
+        legacy_sub_category = cache_get('subcategory', item_id)
+    if legacy_sub_category:
+        main_cat, sub_cat = map_to_defined_category(legacy_sub_category, existing_product['name'])
+        existing_product['category']['main'] = existing_product['category'].get('main') or main_cat
+        existing_product['category']['sub'] = sub_cat
+        is_enriched = True
+    elif not existing_product.get('ai_summary') or not existing_product.get('tags') or not existing_product['category'].get('sub'):
+        print(f"商品 '{existing_product['name']}' のAIメタデータを補完中...")
+        ai_summary, tags, main_cat, sub_cat = generate_ai_metadata(existing_product['name'], existing_product['description'], item_id)
+
+        if main_cat == 'その他':
+            print(f"商品 '{existing_product['name']}' は定義済みカテゴリーに属さないため、カテゴリーを「その他」に設定します。")
+
+        existing_product['ai_summary'] = ai_summary if not existing_product.get('ai_summary') else existing_product['ai_summary']
+        existing_product['tags'] = tags if not existing_product.get('tags') else existing_product['tags']
+        existing_product['category']['main'] = main_cat if not existing_product['category'].get('main') else existing_product['category']['main']
+        existing_product['category']['sub'] = sub_cat if not existing_product['category'].get('sub') else existing_product['category']['sub']
+        is_enriched = True
+
+    if is_price_changed or not existing_product.get('ai_headline') or not existing_product.get('ai_analysis'):
+        print(f"商品 '{existing_product['name']}' のAI分析を更新/生成中...")
+        ai_headline, ai_analysis_text = generate_ai_analysis(existing_product['name'], current_price, price_history, item_id)
+        existing_product['ai_headline'] = ai_headline
+        existing_product['ai_analysis'] = ai_analysis_text
+        is_enriched = True
+    else:
+        print(f"商品 '{existing_product['name']}' の価格に変動がないため、AI分析はスキップされました。")
 
-        else:
-            # 既存商品の処理
-            existing_product = updated_products[item_id]
-            price_history = existing_product.get('price_history', [])
-            
-            if not price_history or price_history[-1].get('date') != current_date:
-                price_history.append({"date": current_date, "price": current_price})
-            
-            last_price = price_history[-2]['price'] if len(price_history) >= 2 else None
-            if last_price and last_price != current_price:
-                is_price_changed = True
-            
-            existing_product['price_history'] = price_history
-            existing_product['price'] = str(current_price)
-
-            if not existing_product.get('ai_summary') or not existing_product.get('tags') or not existing_product['category'].get('sub'):
-                print(f"商品 '{existing_product['name']}' のAIメタデータを補完中...")
-                ai_summary, tags, main_cat, sub_cat = generate_ai_metadata(existing_product['name'], existing_product['description'])
-                
-                if main_cat == 'その他':
-                    print(f"商品 '{existing_product['name']}' は定義済みカテゴリーに属さないため、カテゴリーを「その他」に設定します。")
-                
-                existing_product['ai_summary'] = ai_summary if not existing_product.get('ai_summary') else existing_product['ai_summary']
-                existing_product['tags'] = tags if not existing_product.get('tags') else existing_product['tags']
-                existing_product['category']['main'] = main_cat if not existing_product['category'].get('main') else existing_product['category']['main']
-                existing_product['category']['sub'] = sub_cat if not existing_product['category'].get('sub') else existing_product['category']['sub']
-
-            if is_price_changed or not existing_product.get('ai_headline') or not existing_product.get('ai_analysis'):
-                print(f"商品 '{existing_product['name']}' のAI分析を更新/生成中...")
-                ai_headline, ai_analysis_text = generate_ai_analysis(existing_product['name'], current_price, price_history)
-                existing_product['ai_headline'] = ai_headline
-                existing_product['ai_analysis'] = ai_analysis_text
-            else:
-                print(f"商品 '{existing_product['name']}' の価格に変動がないため、AI分析はスキップされました。")
-            
-            final_products_to_save.append(existing_product)
-    
-    save_to_cache(final_products_to_save)
-    print(f"{CACHE_FILE}が更新されました。現在 {len(final_products_to_save)} 個の商品を追跡中です。")
-    return final_products_to_save
+    if is_enriched:
+        append_enrichment_journal(journal_file, existing_product, current_price)
+    return existing_product
+
+def _with_deal_signals(product):
+    """AI生成の済んだ商品に、ランキング用のお得情報の指標を付けて返す"""
+    product['deal_signals'] = compute_deal_signals(product)
+    return product
+
+def update_products_csv(new_products):
+    """
+    新しい商品データを既存のproducts.csvに統合・更新する関数。
+    取得商品とキャッシュをそれぞれIDでソートして突き合わせ、結果をIDの昇順でCSVに書き出す。
+    """
+    # 前回の実行が途中で止まっていた場合、完了済みのAI生成結果を再利用する
+    journal = load_enrichment_journal()
+
+    fetched_products = external_sort(new_products, key=lambda p: p['id'])
+    cached_products = external_sort(iter_cached_products(), key=lambda p: p['id'])
+
+    with open(ENRICHMENT_JOURNAL_FILE, 'a', encoding='utf-8') as journal_file:
+        enriched_products = (
+            _enrich_product(product, existing_product, journal, journal_file)
+            for product, existing_product in _merge_with_cache(fetched_products, cached_products)
+        )
+        saved_count = save_to_cache(_with_deal_signals(p) for p in enriched_products if p is not None)
+
+    # CSVへの保存が完了したらジャーナルは不要
+    os.remove(ENRICHMENT_JOURNAL_FILE)
+    print(f"{CACHE_FILE}が更新されました。現在 {saved_count} 個の商品を追跡中です。")
+    return saved_count
+
+def parse_price(value):
+    """カンマ区切りなどの価格表記を整数に変換する。変換できない場合はNoneを返す"""
+    try:
+        return int(str(value).replace(',', '').replace('円', '').strip())
+    except (ValueError, TypeError):
+        return None
+
+def compute_deal_signals(product):
+    """
+    価格履歴とポイント倍率から、ランキングに使うお得情報の指標を計算する。
+    drop_percent は過去の最高値からの値下がり率、new_lowest は過去のどの価格よりも安いかどうか。
+    """
+    current_price = parse_price(product.get('price'))
+    history = product.get('price_history', [])
+    # 価格履歴の最後の区間は現在の価格なので、それより前を過去の価格とする
+    # (最後の区間が何日続いても過去の価格には含めないので、最安値を更新した状態は価格が変わるまで続く)
+    past_ranges = [_history_price_range(entry) for entry in history[:-1]]
+
+    drop_percent = 0.0
+    new_lowest = False
+    if current_price is not None and past_ranges:
+        highest_price = max(high for _low, high in past_ranges)
+        if highest_price > current_price:
+            drop_percent = round((highest_price - current_price) / highest_price * 100, 1)
+        new_lowest = current_price < min(low for low, _high in past_ranges)
+
+    try:
+        point_rate = int(product.get('point_rate') or 1)
+    except (ValueError, TypeError):
+        point_rate = 1
+    return {"drop_percent": drop_percent, "new_lowest": new_lowest, "point_rate": point_rate}
+
+def get_deal_signals(product):
+    """保存済みのお得情報の指標を返す。古いデータで未計算の場合はその場で計算する"""
+    signals = product.get('deal_signals')
+    if isinstance(signals, dict) and signals:
+        return signals
+    return compute_deal_signals(product)
+
+def is_sale_product(product):
+    """セール関連のタグが付いている商品かどうか"""
+    return bool(product.get('tags', [])) and any(tag in SALE_TAGS for tag in product['tags'])
+
+def is_point_product(product):
+    """楽天のポイント倍率が高い商品かどうか"""
+    return get_deal_signals(product).get('point_rate', 1) >= POINT_RATE_THRESHOLD
+
+def is_new_lowest_product(product):
+    """現在の価格が過去の価格履歴のどの価格よりも安いかどうか"""
+    return bool(get_deal_signals(product).get('new_lowest'))
 
 def generate_header_footer(current_path, page_title="お得な買い時を見つけよう！"):
     """ヘッダーとフッターのHTMLを生成する"""
@@ -425,8 +1167,21 @@ def generate_header_footer(current_path, page_title="お得な買い時を見つ
                 try {{
                     const dataHistory = JSON.parse(priceChartCanvas.getAttribute('data-history'));
                     if (dataHistory && Array.isArray(dataHistory) && dataHistory.length > 0) {{
-                        const dates = dataHistory.map(item => item.date);
-                        const prices = dataHistory.map(item => item.price);
+                        // ページには価格が変わった日だけが入っているので、次の変化 (最後の価格は今日) まで日ごとに延ばす
+                        const toISODate = day => day.toISOString().slice(0, 10);
+                        const now = new Date();
+                        const today = toISODate(new Date(Date.UTC(now.getFullYear(), now.getMonth(), now.getDate())));
+                        const dates = [];
+                        const prices = [];
+                        dataHistory.forEach((item, i) => {{
+                            const next = i + 1 < dataHistory.length ? dataHistory[i + 1].date : null;
+                            for (const day = new Date(item.date + 'T00:00:00Z'); ; day.setUTCDate(day.getUTCDate() + 1)) {{
+                                const current = toISODate(day);
+                                if (current !== item.date && (next ? current >= next : current > today)) break;
+                                dates.push(current);
+                                prices.push(item.price);
+                            }}
+                        }});
                         new Chart(priceChartCanvas, {{
                             type: 'line',
                             data: {{
@@ -476,183 +1231,101 @@ def generate_product_card_html(product, page_path):
     <img src="{product.get('image_url', '')}" alt="{product.get('name', '商品画像')}">
     <div class="product-info">
         <h3 class="product-name">{product.get('name', '商品名')[:20] + '...' if len(product.get('name', '')) > 20 else product.get('name', '商品名')}</h3>
-        <p class="product-price">{int(product.get('price', 0)):,}円</p>
+        <p class="product-price">{parse_price(product.get('price')) or 0:,}円</p>
         <div class="price-status-title">💡注目ポイント</div>
         <div class="price-status-content ai-analysis">{product.get('ai_headline', 'AI分析準備中')}</div>
     </div>
 </a>"""
 
 
-def generate_site(products):
-    """products.jsonを読み込み、HTMLファイルを生成する関数"""
-    today = date.today().isoformat()
-    for product in products:
-        if 'date' not in product:
-            product['date'] = today
-    products.sort(key=lambda p: p.get('date', '1970-01-01'), reverse=True)
-
-    # カテゴリーを事前に定義したリストから取得
-    categories = PRODUCT_CATEGORIES
-    
-    # カテゴリーごとの商品リストを準備
-    category_products = {cat: [] for cat in categories.keys()}
-    category_products['その他'] = []
-    
-    all_tags = set()
-    for product in products:
-        main_cat = product.get('category', {}).get('main', 'その他')
-        if main_cat in category_products:
-            category_products[main_cat].append(product)
-        else:
-            category_products['その他'].append(product)
-        all_tags.update(product.get('tags', []))
-
-    # 既存の生成ディレクトリをクリーンアップ
-    for dir_name in ['pages', 'category', 'tags']:
-        if os.path.exists(dir_name):
-            shutil.rmtree(dir_name, ignore_errors=True)
-        os.makedirs(dir_name, exist_ok=True)
-    
-    # メインページの生成
-    total_pages = math.ceil(len(products) / PRODUCTS_PER_PAGE)
-    for i in range(total_pages):
-        start_index = i * PRODUCTS_PER_PAGE
-        end_index = start_index + PRODUCTS_PER_PAGE
-        paginated_products = products[start_index:end_index]
-        page_num = i + 1
-        page_path = 'index.html' if page_num == 1 else f'pages/page{page_num}.html'
-        
-        products_html = "".join([generate_product_card_html(p, page_path) for p in paginated_products])
-        
-        pagination_html = ""
-        if total_pages > 1:
-            pagination_html += '<div class="pagination">'
-            if page_num > 1:
-                prev_link = 'index.html' if page_num == 2 else f'pages/page{page_num - 1}.html'
-                pagination_html += f'<a href="{os.path.relpath(prev_link, os.path.dirname(page_path))}" class="prev">前へ</a>'
-            for p in range(1, total_pages + 1):
-                page_link = 'index.html' if p == 1 else f'pages/page{p}.html'
-                active_class = 'active' if p == page_num else ''
-                pagination_html += f'<a href="{os.path.relpath(page_link, os.path.dirname(page_path))}" class="{active_class}">{p}</a>'
-            if page_num < total_pages:
-                next_link = f'pages/page{page_num + 1}.html'
-                pagination_html += f'<a href="{os.path.relpath(next_link, os.path.dirname(page_path))}" class="next">次へ</a>'
-            pagination_html += '</div>'
-
-        main_content_html = f"""
-<main class="container">
-    <div class="ai-recommendation-section">
-        <h2 class="ai-section-title">今が買い時！お得な注目アイテム</h2>
-        <div class="product-grid">
-            {products_html}
-        </div>
-        {pagination_html}
-    </div>
-</main>
-"""
-        header, footer = generate_header_footer(page_path)
-        with open(page_path, 'w', encoding='utf-8') as f:
-            f.write(header + main_content_html + footer)
-        print(f"{page_path} が生成されました。")
-    
-    # カテゴリーごとのページ生成（メインカテゴリーのみ）
-    all_categories = list(categories.keys()) + ['その他']
-    for main_cat in all_categories:
-        main_cat_products = category_products.get(main_cat, [])
-        if not main_cat_products:
-            print(f"警告: メインカテゴリー '{main_cat}' に該当する商品がないため、ページ生成をスキップしました。")
-            continue
-            
-        # カテゴリートップページのみを生成
-        page_path = f"category/{main_cat}/index.html"
-        os.makedirs(os.path.dirname(page_path), exist_ok=True)
-        products_html = "".join([generate_product_card_html(p, page_path) for p in main_cat_products])
-        main_content_html = f"""
+def write_if_changed(path, content):
+    """内容が変わった場合だけファイルを書き換える (変わらないページはタイムスタンプも含めてそのまま残す)"""
+    data = content.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+def _replace_if_changed(tmp_path, path):
+    """一時ファイルの内容が既存のファイルと異なる場合だけ置き換え、同じなら一時ファイルを削除する"""
+    if os.path.exists(path) and filecmp.cmp(tmp_path, path, shallow=False):
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+def _safe_tag_name(tag):
+    """タグ名をファイル名として安全な形に変換する"""
+    return tag.replace('/', '_').replace('\\', '_')
+
+def _start_streamed_page(page_path, page_title, intro_html):
+    """商品カードを逐次書き込むページを開き、ヘッダーから商品グリッドの開始タグまでを書き出す"""
+    os.makedirs(os.path.dirname(page_path) or '.', exist_ok=True)
+    header, footer = generate_header_footer(page_path, page_title=page_title)
+    # 一時ファイルに書き出し、閉じるときに内容が変わっていれば置き換える
+    page_file = open(page_path + '.tmp', 'w', encoding='utf-8')
+    page_file.write(header + f"""
 <main class="container">
     <div class="ai-recommendation-section">
-        <h2 class="ai-section-title">{main_cat}の商品一覧</h2>
-        <!-- タグがサブカテゴリーの役割を果たすことを示す -->
-        <p class="section-description">詳細な絞り込みは、ページ下部のタグをご利用ください。</p>
+{intro_html}
         <div class="product-grid">
-            {products_html}
-        </div>
-    </div>
-</main>
-"""
-        header, footer = generate_header_footer(page_path, page_title=f"{main_cat}の商品一覧")
-        with open(page_path, 'w', encoding='utf-8') as f:
-            f.write(header + main_content_html + footer)
-        print(f"category/{main_cat}/index.html が生成されました。")
-
-    # --- 特別カテゴリー（動的お得情報）のページ生成ロジック ---
-    # ここがご要望の「ポイント特化」と「期間限定セール」の静的ページを生成する部分です。
-    
-    special_categories = {
-        '最安値': sorted([p for p in products], key=lambda x: int(x.get('price', 0))),
-        '期間限定セール': [p for p in products if p.get('tags', []) and any(tag in ['セール', '期間限定', 'タイムセール', '特価'] for tag in p['tags'])],
-        'ポイント特化': [p for p in products if any(keyword in p.get('ai_headline', '') or keyword in p.get('ai_analysis', '') for keyword in ['ポイント', '還元率', 'お得', 'UP'])],
-    }
+            """)
+    return page_file, footer
 
-    for special_cat, filtered_products in special_categories.items():
-        page_path = f"category/{special_cat}/index.html"
-        os.makedirs(os.path.dirname(page_path) or '.', exist_ok=True)
-        products_html = "".join([generate_product_card_html(p, page_path) for p in filtered_products])
-        
-        if special_cat == 'ポイント特化':
-            title = "✨AIが選んだポイント高還元商品"
-            description = "AIが価格分析の結果、「ポイント還元率が高い」「ポイントがお得」と判断した商品をピックアップしています。買い時を見逃さないでください！"
-        elif special_cat == '期間限定セール':
-            title = "🔥限定価格！今すぐ買いたいセール商品"
-            description = "AIがタグや価格変動を分析し、現在セール中・タイムセール中の商品をリアルタイムでリストアップしています。"
-        else:
-            title = f"{special_cat}のお得な商品一覧"
-            description = f"{special_cat}の商品を一覧で表示しています。"
-            
-        main_content_html = f"""
-<main class="container">
-    <div class="ai-recommendation-section">
-        <h2 class="ai-section-title">{title}</h2>
-        <p class="section-description">{description}</p>
-        <div class="product-grid">
-            {products_html}
+def _finish_streamed_page(page_file, footer):
+    """_start_streamed_pageで開いたページの残りを書き出して閉じる"""
+    page_file.write("""
         </div>
     </div>
 </main>
-"""
-        header, footer = generate_header_footer(page_path, page_title=title)
-        with open(page_path, 'w', encoding='utf-8') as f:
-            f.write(header + main_content_html + footer)
-        print(f"category/{special_cat}/index.html が生成されました。")
+""" + footer)
+    page_file.close()
+    _replace_if_changed(page_file.name, page_file.name[:-len('.tmp')])
+
+def _write_index_page(page_num, total_pages, products_html):
+    """トップページ（およびその続きのページ）を1ページ分生成する"""
+    page_path = 'index.html' if page_num == 1 else f'pages/page{page_num}.html'
+
+    pagination_html = ""
+    if total_pages > 1:
+        pagination_html += '<div class="pagination">'
+        if page_num > 1:
+            prev_link = 'index.html' if page_num == 2 else f'pages/page{page_num - 1}.html'
+            pagination_html += f'<a href="{os.path.relpath(prev_link, os.path.dirname(page_path))}" class="prev">前へ</a>'
+        for p in range(1, total_pages + 1):
+            page_link = 'index.html' if p == 1 else f'pages/page{p}.html'
+            active_class = 'active' if p == page_num else ''
+            pagination_html += f'<a href="{os.path.relpath(page_link, os.path.dirname(page_path))}" class="{active_class}">{p}</a>'
+        if page_num < total_pages:
+            next_link = f'pages/page{page_num + 1}.html'
+            pagination_html += f'<a href="{os.path.relpath(next_link, os.path.dirname(page_path))}" class="next">次へ</a>'
+        pagination_html += '</div>'
 
-    # --- 特別カテゴリー（動的お得情報）のページ生成ロジック 終 ---
-
-
-    # タグごとのページ生成
-    all_tags = sorted(list(set(tag for product in products for tag in product.get('tags', []))))
-    for tag in all_tags:
-        safe_tag_name = tag.replace('/', '_').replace('\\', '_')
-        
-        tagged_products = [p for p in products if tag in p.get('tags', [])]
-        tag_path = f"tags/{safe_tag_name}.html"
-        
-        products_html = "".join([generate_product_card_html(p, tag_path) for p in tagged_products])
-        main_content_html = f"""
+    main_content_html = f"""
 <main class="container">
     <div class="ai-recommendation-section">
-        <h2 class="ai-section-title">#{tag}の注目商品</h2>
+        <h2 class="ai-section-title">今が買い時！お得な注目アイテム</h2>
         <div class="product-grid">
             {products_html}
         </div>
+        {pagination_html}
     </div>
 </main>
 """
-        header, footer = generate_header_footer(tag_path, page_title=f"タグ：#{tag}")
-        with open(tag_path, 'w', encoding='utf-8') as f:
-            f.write(header + main_content_html + footer)
-        print(f"{tag_path} が生成されました。")
+    header, footer = generate_header_footer(page_path)
+    write_if_changed(page_path, header + main_content_html + footer)
+    print(f"{page_path} が生成されました。")
 
-    # タグ一覧ページのページネーション
-    TAGS_PER_PAGE = 50
+def _write_tag_index_pages(all_tags):
+    """タグ一覧ページをページネーション付きで生成する。生成したページのパスの一覧を返す"""
+    page_paths = []
     total_tag_pages = math.ceil(len(all_tags) / TAGS_PER_PAGE)
     for i in range(total_tag_pages):
         start_index = i * TAGS_PER_PAGE
@@ -663,7 +1336,7 @@ def generate_site(products):
 
         # 修正: 文字列連結で安全にパスを生成
         tag_links_html = "".join([
-            f'<a href="{os.path.relpath("tags/" + t.replace("/", "_").replace(chr(92), "_") + ".html", os.path.dirname(page_path))}" class="tag-button">#{t}</a>'
+            f'<a href="{os.path.relpath("tags/" + _safe_tag_name(t) + ".html", os.path.dirname(page_path))}" class="tag-button">#{t}</a>'
             for t in paginated_tags
         ])
 
@@ -694,20 +1367,147 @@ def generate_site(products):
 </main>
 """
         header, footer = generate_header_footer(page_path, page_title="タグから探す")
-        with open(page_path, 'w', encoding='utf-8') as f:
-            f.write(header + main_content_html + footer)
+        write_if_changed(page_path, header + main_content_html + footer)
         print(f"{page_path} が生成されました。")
-        
-    # 商品詳細ページの生成
-    for product in products:
-        page_path = product['page_url']
-        dir_name = os.path.dirname(page_path)
-        if dir_name:
-            os.makedirs(dir_name, exist_ok=True)
-        
-        header, footer = generate_header_footer(page_path, page_title=f"{product.get('name', '商品名')}の買い時情報")
-        
-        ai_analysis_block_html = f"""
+        page_paths.append(page_path)
+    return page_paths
+
+def _write_tag_pages(tag_records):
+    """(タグ, 表示順) でソート済みのタグレコードを走査し、タグごとのページを生成する。生成したタグ名の一覧を返す"""
+    all_tags = []
+    page_file = None
+    footer = ""
+    for record in tag_records:
+        tag = record['tag']
+        if not all_tags or all_tags[-1] != tag:
+            if page_file:
+                _finish_streamed_page(page_file, footer)
+                print(f"tags/{_safe_tag_name(all_tags[-1])}.html が生成されました。")
+            all_tags.append(tag)
+            page_file, footer = _start_streamed_page(
+                f"tags/{_safe_tag_name(tag)}.html",
+                f"タグ：#{tag}",
+                f'        <h2 class="ai-section-title">#{tag}の注目商品</h2>'
+            )
+        page_file.write(record['card'])
+    if page_file:
+        _finish_streamed_page(page_file, footer)
+        print(f"tags/{_safe_tag_name(all_tags[-1])}.html が生成されました。")
+    return all_tags
+
+def _push_leaderboard(leaderboard, score, seq, card):
+    """スコアの高い上位LEADERBOARD_SIZE件だけを保持するヒープに商品カードを追加する (同点なら先に来た商品を優先)"""
+    entry = (score, -seq, card)
+    if len(leaderboard) < LEADERBOARD_SIZE:
+        heapq.heappush(leaderboard, entry)
+    elif entry > leaderboard[0]:
+        heapq.heapreplace(leaderboard, entry)
+
+def _leaderboard_cards(leaderboard):
+    """ヒープに残った商品カードをスコアの高い順に返す"""
+    return [card for _score, _neg_seq, card in sorted(leaderboard, reverse=True)]
+
+def _write_leaderboard_page(special_cat, title, description, sections):
+    """ランキング形式の特別カテゴリーページを生成する。sectionsは (見出し, 商品カードのリスト) のリスト"""
+    page_path = f"category/{special_cat}/index.html"
+    os.makedirs(os.path.dirname(page_path), exist_ok=True)
+    sections_html = "".join([f"""
+        <h3 class="product-list-title">{heading}</h3>
+        <div class="product-grid">
+            {"".join(cards)}
+        </div>""" for heading, cards in sections if cards])
+    if not sections_html:
+        sections_html = """
+        <p style="text-align: center; margin-top: 50px;">現在、該当する商品はありません。</p>"""
+
+    main_content_html = f"""
+<main class="container">
+    <div class="ai-recommendation-section">
+        <h2 class="ai-section-title">{title}</h2>
+        <p class="section-description">{description}</p>{sections_html}
+    </div>
+</main>
+"""
+    header, footer = generate_header_footer(page_path, page_title=title)
+    write_if_changed(page_path, header + main_content_html + footer)
+    print(f"{page_path} が生成されました。")
+
+def _leaderboard_scores(product):
+    """
+    商品が載るお得情報ランキングと、そのランキングでのスコア (エンリッチ時に計算済みの指標を使う)。
+    カテゴリーごとの最安値のランキングは "cheapest:カテゴリー名" をキーにする。
+    """
+    signals = get_deal_signals(product)
+    price = parse_price(product.get('price'))
+    scores = {}
+    if price is not None:
+        scores[f"cheapest:{_main_category(product)}"] = -price
+    if signals.get('drop_percent', 0) > 0:
+        scores['drop'] = signals['drop_percent']
+    if signals.get('new_lowest'):
+        scores['new_lowest'] = signals.get('drop_percent', 0)
+    if signals.get('point_rate', 1) >= POINT_RATE_THRESHOLD:
+        scores['point'] = signals['point_rate']
+    return scores
+
+def _write_deal_leaderboard_pages(leaderboard_cards, owns):
+    """
+    最安値・ポイント特化のランキングページのうち、owns(ページのパス) が真になるものを生成する。
+    leaderboard_cards(ランキングのキー) はスコアの高い順の商品カードのリストを返す。生成したページのパスの一覧を返す。
+    """
+    rendered_pages = []
+    # 最安値: 値下がり率・最安値更新・カテゴリーごとの最安値のランキング
+    if owns("category/最安値/index.html"):
+        title, description = SPECIAL_PAGE_TEXTS['最安値']
+        _write_leaderboard_page('最安値', title, description, [
+            ("📉値下がり率ランキング", leaderboard_cards('drop')),
+            ("🏆過去最安値を更新した商品", leaderboard_cards('new_lowest')),
+        ] + [
+            (f"{main_cat}の最安値", leaderboard_cards(f"cheapest:{main_cat}"))
+            for main_cat in list(PRODUCT_CATEGORIES.keys()) + ['その他']
+        ])
+        rendered_pages.append("category/最安値/index.html")
+
+    # ポイント特化: ポイント倍率の高い順のランキング
+    if owns("category/ポイント特化/index.html"):
+        title, description = SPECIAL_PAGE_TEXTS['ポイント特化']
+        _write_leaderboard_page('ポイント特化', title, description, [
+            ("ポイント倍率ランキング", leaderboard_cards('point')),
+        ])
+        rendered_pages.append("category/ポイント特化/index.html")
+    return rendered_pages
+
+def _start_category_page(main_cat):
+    """メインカテゴリーの商品一覧ページを開く (_start_streamed_pageを参照)"""
+    return _start_streamed_page(
+        f"category/{main_cat}/index.html",
+        f"{main_cat}の商品一覧",
+        f'        <h2 class="ai-section-title">{main_cat}の商品一覧</h2>\n'
+        '        <!-- タグがサブカテゴリーの役割を果たすことを示す -->\n'
+        '        <p class="section-description">詳細な絞り込みは、ページ下部のタグをご利用ください。</p>\n'
+        f'        <div id="facet-filter" class="facet-filter" data-category="{main_cat}"></div>\n'
+        '        <script src="../../facet.js"></script>'
+    )
+
+def _start_special_page(special_cat):
+    """全商品から条件に合う商品を並べる特別カテゴリーページを開く (_start_streamed_pageを参照)"""
+    title, description = SPECIAL_PAGE_TEXTS[special_cat]
+    return _start_streamed_page(
+        f"category/{special_cat}/index.html",
+        title,
+        f'        <h2 class="ai-section-title">{title}</h2>\n        <p class="section-description">{description}</p>'
+    )
+
+def _write_product_detail_page(product, similar_products=()):
+    """商品詳細ページを1件生成する"""
+    page_path = product['page_url']
+    dir_name = os.path.dirname(page_path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+
+    header, footer = generate_header_footer(page_path, page_title=f"{product.get('name', '商品名')}の買い時情報")
+
+    ai_analysis_block_html = f"""
 <div class="ai-analysis-block">
     <div class="ai-analysis-text">
         <h2>AIによる買い時分析</h2>
@@ -715,49 +1515,74 @@ def generate_site(products):
     </div>
 </div>
 """
-        price_history_for_chart = product.get('price_history', [])
-        if not price_history_for_chart:
-            try:
-                price_int = int(str(product['price']).replace(',', ''))
-                price_history_for_chart = [{"date": date.today().isoformat(), "price": price_int}]
-            except (ValueError, KeyError):
-                price_history_for_chart = []
-        price_history_json = json.dumps(price_history_for_chart)
-        price_chart_html = f"""
+    price_history_for_chart = price_change_points(product.get('price_history', []))
+    if not price_history_for_chart:
+        # 価格履歴がない場合は、商品を登録した日から現在の価格が続いているものとして表示する
+        price_int = parse_price(product.get('price'))
+        if price_int is not None and product.get('date'):
+            price_history_for_chart = [{"date": product['date'], "price": price_int}]
+    price_history_json = json.dumps(price_history_for_chart)
+    price_chart_html = f"""
 <div class="price-chart-section">
     <h2>価格推移グラフ</h2>
     <canvas id="priceChart" data-history='{price_history_json}'></canvas>
 </div>
 """
-        specs_html = f"""
+    specs_html = f"""
 <div class="item-specs">
     <h2>製品仕様・スペック</h2>
     <p>{product.get('specs', '')}</p>
 </div>
 """ if "specs" in product else ""
 
-        # Yahoo!ショッピングのリンクを修正
-        yahoo_affiliate_link = YAHOO_AFFILIATE_LINK
-
-        affiliate_links_html = f"""
+    # 楽天の価格と、他のマーケットプレイスで見つかったショップの価格を安い順に並べる
+    offers = [{"source": "rakuten", "shop": "", "price": parse_price(product.get('price')) or 0, "url": product.get("rakuten_url", "https://www.rakuten.co.jp/")}]
+    offers += [offer for offer in product.get('offers', []) if offer.get('price')]
+    offers.sort(key=lambda o: (o['price'], o['source'], o['shop']))
+    lowest_offer = offers[0]
+    offers_html = "".join([f"""
+        <li class="offer{' lowest' if offer is lowest_offer else ''}">
+            <span class="offer-shop">{MARKETPLACE_LABELS.get(offer['source'], offer['source'])}{' / ' + offer['shop'] if offer['shop'] else ''}</span>
+            <span class="offer-price">{offer['price']:,}円</span>
+            <a href="{offer['url']}" class="btn shop-link {offer['source']}" rel="nofollow" target="_blank">ショップで見る</a>
+        </li>""" for offer in offers])
+    # 価格が見つからなかったマーケットプレイスは、検索結果へのリンクだけ表示する
+    search_links_html = "".join([
+        f'<a href="{product[f"{source}_url"]}" class="btn shop-link {source}" rel="nofollow" target="_blank">{MARKETPLACE_LABELS[source]}で探す</a>'
+        for source in ['amazon', 'yahoo']
+        if product.get(f"{source}_url") and not any(offer['source'] == source for offer in offers)
+    ])
+    lowest_summary_html = f"""
+    <p class="lowest-price-summary">最安値：<span>{lowest_offer['price']:,}</span>円（{MARKETPLACE_LABELS.get(lowest_offer['source'], lowest_offer['source'])}{' / ' + lowest_offer['shop'] if lowest_offer['shop'] else ''}）</p>""" if len(offers) > 1 else ""
+
+    affiliate_links_html = f"""
 <div class="lowest-price-section">
-    <p class="lowest-price-label">最安値ショップをチェック！</p>
+    <p class="lowest-price-label">最安値ショップをチェック！</p>{lowest_summary_html}
+    <ul class="offer-list">{offers_html}
+    </ul>
     <div class="lowest-price-buttons">
-        <a href="{AMAZON_AFFILIATE_LINK}" class="btn shop-link amazon" target="_blank">Amazonで見る</a>
-        <a href="{product.get("rakuten_url", "https://www.rakuten.co.jp/")}" class="btn shop-link rakuten" target="_blank">楽天市場で見る</a>
-        <a href="{yahoo_affiliate_link}" class="btn shop-link yahoo" rel="nofollow" target="_blank">Yahoo!ショッピングで見る</a>
+        {search_links_html}
     </div>
 </div>
 """
-        
-        # 現在のページからルートディレクトリへの相対パスを計算
-        rel_path_to_root = os.path.relpath('.', os.path.dirname(page_path))
-        if rel_path_to_root == '.':
-            base_path = './'
-        else:
-            base_path = rel_path_to_root + '/'
 
-        item_html_content = f"""
+    similar_products_html = f"""
+<div class="similar-products ai-recommendation-section">
+    <h2 class="ai-section-title">この商品に似ている商品</h2>
+    <div class="product-grid">
+        {"".join([generate_product_card_html(p, page_path) for p in similar_products])}
+    </div>
+</div>
+""" if similar_products else ""
+
+    # 現在のページからルートディレクトリへの相対パスを計算
+    rel_path_to_root = os.path.relpath('.', os.path.dirname(page_path))
+    if rel_path_to_root == '.':
+        base_path = './'
+    else:
+        base_path = rel_path_to_root + '/'
+
+    item_html_content = f"""
 <main class="container">
     <div class="product-detail">
         <div class="item-detail">
@@ -768,7 +1593,7 @@ def generate_site(products):
                 <h1 class="item-name">{product.get('name', '商品名')}</h1>
                 <!-- パンくずリストを削除 -->
                 <div class="price-section">
-                    <p class="current-price">現在の価格：<span>{int(product.get('price', 0)):,}</span>円</p>
+                    <p class="current-price">現在の価格：<span>{parse_price(product.get('price')) or 0:,}</span>円</p>
                 </div>
                 <div class="ai-recommendation-section">
                     <div class="price-status-title">💡注目ポイント</div>
@@ -786,93 +1611,742 @@ def generate_site(products):
                 </div>
                 {specs_html}
                 <div class="product-tags">
-                    {"".join([f'<a href="{base_path}tags/{tag.replace("/", "_").replace(chr(92), "_")}.html" class="tag-button">#{tag}</a>' for tag in product.get("tags", [])])}
+                    {"".join([f'<a href="{base_path}tags/{_safe_tag_name(tag)}.html" class="tag-button">#{tag}</a>' for tag in product.get("tags", [])])}
                 </div>
             </div>
         </div>
     </div>
+    {similar_products_html}
 </main>
 """
-        with open(page_path, 'w', encoding='utf-8') as f:
-            f.write(header + item_html_content + footer)
-        print(f"{page_path} が生成されました。")
-        
-    # sitemap.xmlの生成
-    sitemap_content = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    sitemap_content += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    write_if_changed(page_path, header + item_html_content + footer)
+    print(f"{page_path} が生成されました。")
+
+def _similarity_terms(product):
+    """類似度計算に使う語を商品名・タグ・AI要約から取り出す"""
+    text = f"{product.get('name', '')} {product.get('ai_summary', '')}".lower()
+    terms = []
+    # 英数字は単語単位、日本語などはわかち書きをせずに文字bigramで扱う
+    for token in re.findall(r'[a-z0-9]+|[^\W\da-z_]+', text):
+        if token[0].isascii():
+            terms.append(token)
+        elif len(token) == 1:
+            terms.append(token)
+        else:
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+    # タグは商品の特徴をよく表すので、本文の語より重く扱う
+    for tag in product.get('tags', []):
+        terms.extend([f"#{tag.lower()}"] * SIMILARITY_TAG_WEIGHT)
+    return terms
+
+def _encode_similarity_terms(product, vocabulary):
+    """
+    商品の語を、語番号 (int32) の並びのあとに出現回数 (float32) の並びが続くバイナリのレコードにする。
+    vocabularyにない語には新しい語番号を割り当てる。
+    """
+    term_counts = {}
+    for term in _similarity_terms(product):
+        term_id = vocabulary.setdefault(term, len(vocabulary))
+        term_counts[term_id] = term_counts.get(term_id, 0) + 1
+    return array('i', term_counts.keys()).tobytes() + array('f', term_counts.values()).tobytes()
+
+def _spool_similarity_terms(products, is_query, card_spool, term_record_for):
+    """
+    商品ごとの語のレコード (term_record_for(商品) が返す) を一時ファイルに書き出す。
+    card_spoolを指定した場合は、類似商品カードの描画に必要な項目だけをJSON Linesで書き出す。
+    戻り値は (語の一時ファイル, 各商品の語の数, 類似商品を求める商品番号, 各商品のカードの位置)。
+    """
+    term_spool = tempfile.TemporaryFile('w+b')
+    row_lengths = array('i')
+    query_rows = array('i')
+    card_offsets = array('q')
+    for doc_id, product in enumerate(products):
+        if is_query is None or is_query(product):
+            query_rows.append(doc_id)
+        record = term_record_for(product)
+        term_spool.write(record)
+        row_lengths.append(len(record) // 8)
+        if card_spool is not None:
+            card_offsets.append(card_spool.tell())
+            card = {key: product.get(key, '') for key in ['page_url', 'name', 'price', 'image_url', 'ai_headline']}
+            card_spool.write((json.dumps(card, ensure_ascii=False) + '\n').encode('utf-8'))
+    return term_spool, row_lengths, query_rows, card_offsets
+
+def read_similar_card(card_spool, card_offsets, row):
+    """build_similar_productsが書き出した商品カード用データを、商品番号を指定して読み込む"""
+    card_spool.seek(card_offsets[row])
+    return json.loads(card_spool.readline())
+
+def _read_tfidf_rows(np, term_data, row_offsets, row_lengths, rows, idf, useful):
+    """
+    語の一時ファイル (term_dataはそのメモリマップ) からrowsの商品の語を読み込み、TF-IDFの重み (行ごとにL2正規化) にして返す。
+    戻り値は (rowsの中での番号, 語番号, 重み) で、各非ゼロ要素を並べたもの。
+    """
+    rows = np.asarray(rows)
+    lengths = row_lengths[rows]
+    # 各商品のレコードの先頭位置から、語番号の位置と、その後ろに続く出現回数の位置を求める
+    positions = np.arange(int(lengths.sum())) + np.repeat(row_offsets[rows] - (np.cumsum(lengths) - lengths), lengths)
+    doc_ids = np.repeat(np.arange(len(rows), dtype=np.int32), lengths)
+    term_ids = term_data[positions]
+    counts = term_data.view(np.float32)[positions + np.repeat(lengths, lengths)]
+
+    # 1商品にしか現れない語は類似度に寄与せず、ほぼ全商品に現れる語は区別に役立たないので除く
+    keep = useful[term_ids]
+    doc_ids, term_ids, counts = doc_ids[keep], term_ids[keep], counts[keep]
+    weights = ((1 + np.log(counts)) * idf[term_ids]).astype(np.float32)
+    norms = np.sqrt(np.bincount(doc_ids, weights=weights * weights, minlength=len(rows)))
+    weights /= norms[doc_ids]
+    return doc_ids, term_ids, weights
+
+def _select_top_k(np, scores, batch_rows, k):
+    """
+    類似度行列のバッチ (batch_rowsの商品の行) から、各行の上位k件 (自分自身は除く) を取り出す。
+    戻り値は (商品番号, 類似度) の配列で、類似度の高い順、同点なら商品番号順。k件に満たない分は番号-1で埋める。
+    """
+    rows = np.arange(scores.shape[0])
+    scores[rows, batch_rows] = -1
+    top_ids = np.full((len(rows), k), -1, dtype=np.int32)
+    top_scores = np.full((len(rows), k), -1, dtype=scores.dtype)
+    count = min(k, scores.shape[1] - 1)
+    if count <= 0:
+        return top_ids, top_scores
+    candidates = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.lexsort((candidates, -candidate_scores), axis=1)
+    top_ids[:, :count] = np.take_along_axis(candidates, order, axis=1)
+    top_scores[:, :count] = np.take_along_axis(candidate_scores, order, axis=1)
+    return top_ids, top_scores
+
+def _top_k_exact(np, doc_ids, term_ids, weights, doc_count, vocab_size, query_rows, k):
+    """転置インデックスを使い、query_rowsの商品についてバッチ単位で全商品とのコサイン類似度を正確に計算する"""
+    # 語ごとの出現商品リスト (転置インデックス)
+    order = np.argsort(term_ids, kind='stable')
+    posting_docs = doc_ids[order]
+    posting_weights = weights[order]
+    posting_ptr = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=vocab_size))])
+    row_ptr = np.concatenate([[0], np.cumsum(np.bincount(doc_ids, minlength=doc_count))])
+
+    top_ids, top_scores = [], []
+    for start in range(0, len(query_rows), SIMILARITY_BATCH_SIZE):
+        batch_rows = query_rows[start:start + SIMILARITY_BATCH_SIZE]
+        # バッチ内の各商品の非ゼロ要素を集める
+        row_lengths = row_ptr[batch_rows + 1] - row_ptr[batch_rows]
+        nonzero_positions = np.arange(int(row_lengths.sum())) + np.repeat(row_ptr[batch_rows] - (np.cumsum(row_lengths) - row_lengths), row_lengths)
+        batch_local_rows = np.repeat(np.arange(len(batch_rows)), row_lengths)
+        query_terms = term_ids[nonzero_positions]
+        query_weights = weights[nonzero_positions]
+
+        # 各クエリ語の出現商品リストを展開し、(クエリ行, 商品) ごとに重みの積を合計する
+        lengths = posting_ptr[query_terms + 1] - posting_ptr[query_terms]
+        total = int(lengths.sum())
+        offsets = np.repeat(posting_ptr[query_terms] - (np.cumsum(lengths) - lengths), lengths)
+        positions = np.arange(total) + offsets
+        flat_index = np.repeat(batch_local_rows, lengths).astype(np.int64) * doc_count + posting_docs[positions]
+        products_of_weights = np.repeat(query_weights, lengths) * posting_weights[positions]
+        scores = np.bincount(flat_index, weights=products_of_weights, minlength=len(batch_rows) * doc_count)
+        batch_ids, batch_scores = _select_top_k(np, scores.reshape(len(batch_rows), doc_count), batch_rows, k)
+        top_ids.append(batch_ids)
+        top_scores.append(batch_scores)
+    return np.concatenate(top_ids), np.concatenate(top_scores)
+
+def _blocking_terms(np, term_data, row_offsets, row_lengths, idf, useful):
+    """
+    各商品の重みの大きい語を最大SIMILARITY_BLOCK_TERMS個選び、(語番号, 商品番号) の組を語番号順に並べて返す。
+    同じ語を持つ商品が、近似計算で類似度を計算する候補のバケットになる。
+    """
+    doc_count = len(row_lengths)
+    block_terms, block_rows = [], []
+    for start in range(0, doc_count, SIMILARITY_BATCH_SIZE * 16):
+        rows = np.arange(start, min(start + SIMILARITY_BATCH_SIZE * 16, doc_count))
+        doc_ids, term_ids, weights = _read_tfidf_rows(np, term_data, row_offsets, row_lengths, rows, idf, useful)
+        # 商品ごとに重みの大きい順 (同じ重みなら語番号順) に並べ、先頭から順位を付ける
+        order = np.lexsort((term_ids, -weights, doc_ids))
+        doc_ids, term_ids = doc_ids[order], term_ids[order]
+        doc_starts = np.searchsorted(doc_ids, doc_ids, side='left')
+        top = np.arange(len(doc_ids)) - doc_starts < SIMILARITY_BLOCK_TERMS
+        block_terms.append(term_ids[top])
+        block_rows.append(rows[doc_ids[top]])
+    block_terms = np.concatenate(block_terms)
+    block_rows = np.concatenate(block_rows).astype(np.int32)
+    order = np.lexsort((block_rows, block_terms))
+    return block_terms[order], block_rows[order]
+
+def _merge_top_k(np, top_ids, top_scores, ids, scores, k):
+    """2つの上位k件の結果をまとめ、同じ商品の重複を除いて上位k件を選び直す"""
+    ids = np.concatenate([top_ids, ids], axis=1)
+    scores = np.concatenate([top_scores, scores], axis=1)
+    # 同じ商品は同じ類似度になるので、商品番号順に並べて2件目以降を候補から外す
+    order = np.argsort(ids, axis=1, kind='stable')
+    ids = np.take_along_axis(ids, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    duplicate = np.zeros(ids.shape, dtype=bool)
+    duplicate[:, 1:] = (ids[:, 1:] == ids[:, :-1]) & (ids[:, 1:] >= 0)
+    scores[duplicate] = -1
+    ids[duplicate] = -1
+    order = np.lexsort((ids, -scores), axis=1)[:, :k]
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+def _top_k_blocked(np, term_data, row_offsets, row_lengths, idf, useful, query_rows, k):
+    """
+    商品数が多い場合の近似計算。重みの大きい語が同じ商品をバケットにまとめ、
+    バケットをSIMILARITY_MAX_BUCKET_SIZE件程度ずつのグループにして、グループ内の商品どうしだけで正確なコサイン類似度を計算する
+    (全商品の組み合わせは計算しない)。
+    """
+    doc_count = len(row_lengths)
+    is_query = np.zeros(doc_count, dtype=bool)
+    is_query[query_rows] = True
+    query_position = np.full(doc_count, -1, dtype=np.int64)
+    query_position[query_rows] = np.arange(len(query_rows))
+    top_ids = np.full((len(query_rows), k), -1, dtype=np.int32)
+    top_scores = np.full((len(query_rows), k), -1, dtype=np.float64)
+
+    def score_group(group):
+        members = np.unique(np.concatenate(group))
+        local_query_rows = np.flatnonzero(is_query[members])
+        if not len(local_query_rows):
+            return
+        doc_ids, term_ids, weights = _read_tfidf_rows(np, term_data, row_offsets, row_lengths, members, idf, useful)
+        local_terms, local_term_ids = np.unique(term_ids, return_inverse=True)
+        ids, scores = _top_k_exact(np, doc_ids, local_term_ids.astype(np.int32), weights, len(members), len(local_terms), local_query_rows, k)
+        ids = np.where(ids >= 0, members[np.maximum(ids, 0)], -1)
+        positions = query_position[members[local_query_rows]]
+        top_ids[positions], top_scores[positions] = _merge_top_k(np, top_ids[positions], top_scores[positions], ids, scores, k)
+
+    block_terms, block_rows = _blocking_terms(np, term_data, row_offsets, row_lengths, idf, useful)
+    boundaries = np.flatnonzero(block_terms[1:] != block_terms[:-1]) + 1
+    group, group_size = [], 0
+    for start, end in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [len(block_terms)]])):
+        if end - start < 2:
+            continue
+        # 大きすぎるバケットは、商品番号順に区切って計算量を抑える
+        for window_start in range(start, end, SIMILARITY_MAX_BUCKET_SIZE):
+            window = block_rows[window_start:min(end, window_start + SIMILARITY_MAX_BUCKET_SIZE)]
+            if group_size + len(window) > SIMILARITY_MAX_BUCKET_SIZE:
+                score_group(group)
+                group, group_size = [], 0
+            group.append(window)
+            group_size += len(window)
+    if group:
+        score_group(group)
+    return top_ids, top_scores
+
+def build_similar_products(products, card_spool=None, k=SIMILAR_PRODUCTS_COUNT, is_query=None, term_cache=None):
+    """
+    商品名・タグ・AI要約のTF-IDFベクトルから、各商品に似ている商品を最大k件求める。
+    語と商品カード用データは一時ファイルに書き出して商品番号 (入力の並び順) で参照するため、カタログ全体をメモリに載せない。
+    戻り値は (card_spool内の各商品のカードの位置, 類似商品を求めた商品の番号 → 類似商品の番号リスト)。
+    is_queryを指定した場合は、それが真になる商品についてのみ類似商品を求める。
+    term_cache ({"vocabulary": 語 → 語番号, "records": 商品ID → 語のレコード}) を指定した場合は、
+    商品ごとの語のレコードを呼び出しをまたいで使い回す (変更された商品のレコードは呼び出し側で削除する)。
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        print("警告: numpyがインストールされていないため、類似商品の計算をスキップします。")
+        return array('q'), {}
+
+    if term_cache is None:
+        vocabulary = {}
+        term_record_for = lambda product: _encode_similarity_terms(product, vocabulary)
+    else:
+        vocabulary = term_cache['vocabulary']
+        records = term_cache['records']
+
+        def term_record_for(product):
+            record = records.get(product['id'])
+            if record is None:
+                record = records[product['id']] = _encode_similarity_terms(product, vocabulary)
+            return record
+
+    term_spool, row_lengths, query_rows, card_offsets = _spool_similarity_terms(products, is_query, card_spool, term_record_for)
+    doc_count = len(row_lengths)
+    term_spool.flush()
+    if doc_count < 2 or not query_rows or not term_spool.tell():
+        term_spool.close()
+        return card_offsets, {}
+
+    # 語の一時ファイルはメモリマップで参照し、必要な商品の分だけを読み込む
+    term_data = np.memmap(term_spool, dtype=np.int32, mode='r')
+    row_lengths = np.frombuffer(row_lengths, dtype=np.int32).astype(np.int64)
+    # 各商品のレコードの先頭位置 (4バイト単位)。1商品のレコードは語番号と出現回数が語の数ずつ並ぶ
+    row_offsets = np.concatenate([[0], np.cumsum(row_lengths * 2)[:-1]])
+    query_rows = np.frombuffer(query_rows, dtype=np.int32)
+    # 語ごとの出現商品数 (1商品のレコード内で語番号は重複しない)
+    term_positions = np.arange(int(row_lengths.sum())) + np.repeat(row_offsets - (np.cumsum(row_lengths) - row_lengths), row_lengths)
+    df = np.bincount(term_data[term_positions], minlength=len(vocabulary))
+    useful = (df >= 2) & (df <= SIMILARITY_MAX_DF_RATIO * doc_count)
+    idf = np.log((1 + doc_count) / (1 + df)) + 1
+
+    if doc_count <= EXACT_SIMILARITY_LIMIT:
+        doc_ids, term_ids, weights = _read_tfidf_rows(np, term_data, row_offsets, row_lengths, np.arange(doc_count), idf, useful)
+        top_ids, top_scores = _top_k_exact(np, doc_ids, term_ids, weights, doc_count, len(df), query_rows, k)
+    else:
+        print(f"商品数が {EXACT_SIMILARITY_LIMIT} 件を超えるため、類似商品は近似計算で求めます。")
+        top_ids, top_scores = _top_k_blocked(np, term_data, row_offsets, row_lengths, idf, useful, query_rows, k)
+    del term_data
+    term_spool.close()
+
+    neighbors = {
+        int(row): [int(i) for i, score in zip(row_ids, row_scores) if i >= 0 and score >= SIMILARITY_MIN_SCORE]
+        for row, row_ids, row_scores in zip(query_rows, top_ids, top_scores)
+    }
+    print(f"{len(query_rows)} 件の商品について類似商品を計算しました。")
+    return card_offsets, neighbors
+
+def _write_sitemap_entry(sitemap_file, url, changefreq, priority, lastmod):
+    """sitemap.xmlに1件分のURLを書き出す"""
+    sitemap_file.write('  <url>\n')
+    sitemap_file.write(f'    <loc>{url}</loc>\n')
+    sitemap_file.write(f'    <lastmod>{lastmod}</lastmod>\n')
+    sitemap_file.write(f'    <changefreq>{changefreq}</changefreq>\n')
+    sitemap_file.write(f'    <priority>{priority}</priority>\n')
+    sitemap_file.write('  </url>\n')
+
+def parse_shard(value):
+    """'i/N' 形式のシャード指定 (iは1始まり) を (0始まりの番号, シャード数) に変換する"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"シャードは 'i/N' の形式で指定してください: {value}")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"シャード番号は 1 から N の範囲で指定してください: {value}")
+    return index - 1, count
+
+def shard_of(key, shard_count):
+    """ページのパスをハッシュして担当シャードを決める (実行環境によらず同じ結果になる)"""
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % shard_count
+
+def _shard_manifest_path(index, count):
+    return os.path.join(BUILD_MANIFEST_DIR, f"shard-{index + 1}-of-{count}.json")
+
+def _write_shard_manifest(shard, page_paths):
+    """シャードが生成したページの一覧をマニフェストの断片として書き出す"""
+    index, count = shard
+    os.makedirs(BUILD_MANIFEST_DIR, exist_ok=True)
+    with open(_shard_manifest_path(index, count), 'w', encoding='utf-8') as f:
+        json.dump({"shard": index + 1, "shards": count, "pages": sorted(page_paths)}, f, ensure_ascii=False, indent=2)
+    print(f"{_shard_manifest_path(index, count)} が生成されました ({len(page_paths)} ページ)。")
+
+def _remove_stale_pages(page_paths):
+    """生成対象のディレクトリから、page_pathsに含まれない古いファイルと空のディレクトリを削除する"""
+    page_paths = set(page_paths)
+    removed_count = 0
+    for dir_name in GENERATED_PAGE_DIRS:
+        for root, _dirs, files in os.walk(dir_name, topdown=False):
+            for file_name in files:
+                path = os.path.join(root, file_name).replace(os.sep, '/')
+                if path not in page_paths:
+                    os.remove(path)
+                    removed_count += 1
+            if root != dir_name and not os.listdir(root):
+                os.rmdir(root)
+    return removed_count
+
+def merge_shards(shard_count):
+    """
+    各シャードのマニフェストの断片をまとめ、どのシャードも生成しなかった古いページを削除する。
+    すべての断片が揃っていない場合は何もせずにFalseを返す。
+    """
+    page_paths = set()
+    for index in range(shard_count):
+        manifest_path = _shard_manifest_path(index, shard_count)
+        if not os.path.exists(manifest_path):
+            print(f"エラー: {manifest_path} が見つかりません。すべてのシャードの生成結果を揃えてからマージしてください。")
+            return False
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            page_paths.update(json.load(f)['pages'])
+
+    removed_count = _remove_stale_pages(page_paths)
+    print(f"{shard_count} 個のシャードの {len(page_paths)} ページをマージしました (古いページを {removed_count} 件削除)。")
+    return True
+
+def _date_sort_key(product):
+    """商品を日付の新しい順 (同じ日付ならIDの昇順) に並べるためのキー"""
+    try:
+        day = date.fromisoformat(product.get('date') or '1970-01-01').toordinal()
+    except ValueError:
+        day = date(1970, 1, 1).toordinal()
+    return -day, product.get('id', '')
+
+def generate_site(products, shard=None):
+    """
+    商品データを1件ずつ受け取り、HTMLファイルを生成する関数。
+    商品は日付順に外部ソートしてディスクに退避し、一度の走査で各ページへ書き出すため、
+    カタログ全体をメモリに載せずに生成できる。
+    shard に (番号, シャード数) を指定すると、ページのパスのハッシュで割り当てられたページだけを生成し、
+    生成したページの一覧を build_manifest/ に書き出す (ランキングやページ分割は全商品から計算する)。
+    """
+    today = date.today().isoformat()
+
+    def owns(page_path):
+        return shard is None or shard_of(page_path, shard[1]) == shard[0]
+
+    def with_default_date(items):
+        for product in items:
+            if 'date' not in product:
+                product['date'] = today
+            yield product
+
+    # 日付の新しい順。同じ日付の商品はIDの昇順に並べ、実行ごとに順序が変わらないようにする
+    sorted_spool, product_count = spool_to_disk(
+        external_sort(with_default_date(products), key=_date_sort_key)
+    )
+
+    # 商品詳細ページに表示する類似商品 (番号は日付順に並べた商品の位置。カードは一時ファイルから読み込む)
+    card_spool = tempfile.TemporaryFile('w+b')
+    card_offsets, similar_neighbors = build_similar_products(
+        iter_spool(sorted_spool), card_spool, is_query=lambda product: owns(product['page_url'])
+    )
+
+    rendered_pages = render_pages(
+        iter_spool(sorted_spool), product_count,
+        lambda seq, product: [read_similar_card(card_spool, card_offsets, i) for i in similar_neighbors.get(seq, [])],
+        owns
+    )
+    card_spool.close()
+    sorted_spool.close()
+
+    # プレースホルダーページも他のページと同じく、担当するシャードだけが生成してマニフェストに載せる
+    if owns("ai_search.html"):
+        write_placeholder_pages()
+        rendered_pages.append("ai_search.html")
+
+    if shard is not None:
+        # 分割ビルドでは他のシャードのページを残し、マージ時に古いページを削除する
+        _write_shard_manifest(shard, rendered_pages)
+    else:
+        removed_count = _remove_stale_pages(rendered_pages)
+        if removed_count:
+            print(f"古いページを {removed_count} 件削除しました。")
+
+def render_pages(sorted_products, product_count, similar_products_for, owns):
+    """
+    日付順に並んだ商品を一度だけ走査し、owns(ページのパス) が真になるページを生成する。
+    similar_products_for(番号, 商品) は商品詳細ページに表示する類似商品を返す。生成したページのパスの一覧を返す。
+    """
+    rendered_pages = []
+
+    # カテゴリーを事前に定義したリストから取得
+    all_categories = list(PRODUCT_CATEGORIES.keys()) + ['その他']
+
+    # 既存のページは削除せず、内容が変わったものだけ書き換える (古いページは最後にまとめて削除する)
+    for dir_name in GENERATED_PAGE_DIRS:
+        os.makedirs(dir_name, exist_ok=True)
+
+    # --- 特別カテゴリー（動的お得情報）のページ定義 ---
+    # ここがご要望の「ポイント特化」と「期間限定セール」の静的ページを生成する部分です。
+    special_filters = {
+        '期間限定セール': is_sale_product,
+    }
+    special_pages = {
+        special_cat: _start_special_page(special_cat)
+        for special_cat in special_filters if owns(f"category/{special_cat}/index.html")
+    }
+    category_pages = {}
+    # お得情報のランキングは上位LEADERBOARD_SIZE件だけをヒープで保持する
+    leaderboards = {}
+    # タグ順に並べ替えが必要なレコードは一時ファイルに書き出しておく
+    tag_spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+    tag_names = set()
+    leaderboards_owned = owns("category/最安値/index.html") or owns("category/ポイント特化/index.html")
+
+    # 日付順に1回だけ走査し、各ページへ商品カードを振り分ける (生成しないページのカードは作らない)
+    total_pages = math.ceil(product_count / PRODUCTS_PER_PAGE)
+    page_cards = []
+    for seq, product in enumerate(sorted_products):
+        # メインページ (PRODUCTS_PER_PAGE件たまるごとに1ページ書き出す)
+        page_num = seq // PRODUCTS_PER_PAGE + 1
+        index_page_path = 'index.html' if page_num == 1 else f'pages/page{page_num}.html'
+        if owns(index_page_path):
+            page_cards.append(generate_product_card_html(product, index_page_path))
+            if len(page_cards) == PRODUCTS_PER_PAGE:
+                _write_index_page(page_num, total_pages, "".join(page_cards))
+                rendered_pages.append(index_page_path)
+                page_cards = []
+
+        # カテゴリーごとのページ（メインカテゴリーのみ）
+        main_cat = _main_category(product)
+        category_path = f"category/{main_cat}/index.html"
+        if main_cat not in category_pages and owns(category_path):
+            category_pages[main_cat] = _start_category_page(main_cat)
+        # 特別カテゴリー
+        special_cats = [
+            special_cat for special_cat, matches in special_filters.items()
+            if special_cat in special_pages and matches(product)
+        ]
+        if main_cat in category_pages or special_cats or leaderboards_owned:
+            # カテゴリーページと特別カテゴリーページは同じ階層なので、カードを使い回せる
+            category_card = generate_product_card_html(product, category_path)
+            if main_cat in category_pages:
+                category_pages[main_cat][0].write(category_card)
+            for special_cat in special_cats:
+                special_pages[special_cat][0].write(category_card)
+
+        # お得情報のランキング (エンリッチ時に計算済みの指標を使う)
+        if leaderboards_owned:
+            for leaderboard_key, score in _leaderboard_scores(product).items():
+                _push_leaderboard(leaderboards.setdefault(leaderboard_key, []), score, seq, category_card)
+
+        # タグページ用のレコード
+        tags = product.get('tags', [])
+        tag_names.update(tags)
+        owned_tags = [tag for tag in tags if owns(f"tags/{_safe_tag_name(tag)}.html")]
+        if owned_tags:
+            tag_card = generate_product_card_html(product, "tags/index.html")
+            for tag in owned_tags:
+                tag_spool.write(json.dumps({"tag": tag, "seq": seq, "card": tag_card}, ensure_ascii=False) + '\n')
+
+        # 商品詳細ページ
+        if owns(product['page_url']):
+            _write_product_detail_page(product, similar_products_for(seq, product))
+            rendered_pages.append(product['page_url'])
+
+    if page_cards:
+        _write_index_page(total_pages, total_pages, "".join(page_cards))
+        rendered_pages.append('index.html' if total_pages == 1 else f'pages/page{total_pages}.html')
+
+    for main_cat in all_categories:
+        if main_cat not in category_pages:
+            if owns(f"category/{main_cat}/index.html"):
+                print(f"警告: メインカテゴリー '{main_cat}' に該当する商品がないため、ページ生成をスキップしました。")
+            continue
+        _finish_streamed_page(*category_pages[main_cat])
+        print(f"category/{main_cat}/index.html が生成されました。")
+        rendered_pages.append(f"category/{main_cat}/index.html")
+
+    # 最安値・ポイント特化のランキングページ
+    rendered_pages.extend(_write_deal_leaderboard_pages(
+        lambda leaderboard_key: _leaderboard_cards(leaderboards.get(leaderboard_key, [])), owns
+    ))
+
+    for special_cat, (page_file, footer) in special_pages.items():
+        _finish_streamed_page(page_file, footer)
+        print(f"category/{special_cat}/index.html が生成されました。")
+        rendered_pages.append(f"category/{special_cat}/index.html")
+
+    # --- 特別カテゴリー（動的お得情報）のページ生成ロジック 終 ---
+
+    # タグごとのページ生成 (タグ名順、同じタグ内は日付順)
+    for tag in _write_tag_pages(external_sort(iter_spool(tag_spool), key=lambda r: (r['tag'], r['seq']))):
+        rendered_pages.append(f"tags/{_safe_tag_name(tag)}.html")
+    tag_spool.close()
+
+    # タグ一覧ページのページネーション (一覧のページ群はまとめて1つのシャードが担当する)
+    if owns("tags/index.html"):
+        rendered_pages.extend(_write_tag_index_pages(sorted(tag_names)))
+    return rendered_pages
+
+def _load_sitemap_lastmod():
+    """前回のsitemap生成時に記録した、ページごとの (内容のハッシュ, 更新日) を読み込む"""
+    if not os.path.exists(SITEMAP_LASTMOD_FILE):
+        return {}
+    try:
+        with open(SITEMAP_LASTMOD_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        print(f"警告: {SITEMAP_LASTMOD_FILE} の読み込みに失敗しました: {e}")
+        return {}
+
+def generate_sitemap(products):
+    """
+    商品データを1件ずつ読みながらsitemap.xmlを生成する。
+    lastmodは生成済みのページの内容が前回から変わった場合だけ今日の日付に更新する。
+    """
     base_url = "https://your-website.com/"
-    sitemap_urls = [
-        (base_url, 'daily', '1.0'),
-        (f'{base_url}privacy.html', 'monthly', '0.5'),
-        (f'{base_url}disclaimer.html', 'monthly', '0.5'),
-        (f'{base_url}contact.html', 'monthly', '0.5'),
-        (f'{base_url}search_results.html', 'daily', '0.5'),
-        (f'{base_url}ai_search.html', 'weekly', '0.7') # AIで探すのページを追加
-    ]
+    product_count = 0
+    all_tags = set()
+    today = date.today().isoformat()
+    previous_lastmod = _load_sitemap_lastmod()
+    lastmod_records = {}
 
-    for product in products:
-        sitemap_urls.append((f'{base_url}{product.get("page_url", "")}', 'daily', '0.6'))
-    
-    total_pages = math.ceil(len(products) / PRODUCTS_PER_PAGE)
-    for i in range(2, total_pages + 1):
-        sitemap_urls.append((f'{base_url}pages/page{i}.html', 'daily', '0.8'))
-
-    # カテゴリーページを追加 (サブカテゴリーは削除)
-    all_categories_sitemap = list(PRODUCT_CATEGORIES.keys()) + ['その他']
-    for main_cat in all_categories_sitemap:
-        # メインカテゴリーのindex.htmlのみ追加
-        sitemap_urls.append((f'{base_url}category/{main_cat}/index.html', 'daily', '0.8'))
-    
-    # 特別カテゴリー（動的お得情報）も追加
-    for special_cat in ['最安値', '期間限定セール', 'ポイント特化']:
-        sitemap_urls.append((f'{base_url}category/{special_cat}/index.html', 'daily', '0.8'))
-
-    # タグページを追加
-    all_tags_sitemap = sorted(list(set(tag for product in products for tag in product.get('tags', []))))
-    sitemap_urls.append((f'{base_url}tags/index.html', 'weekly', '0.7')) # タグ一覧ページ
-    for tag in all_tags_sitemap:
-        safe_tag_name = tag.replace("/", "_").replace("\\", "_")
-        sitemap_urls.append((f'{base_url}tags/{safe_tag_name}.html', 'daily', '0.6'))
-    
-    total_tag_pages_sitemap = math.ceil(len(all_tags_sitemap) / TAGS_PER_PAGE)
-    for i in range(2, total_tag_pages_sitemap + 1):
-        sitemap_urls.append((f'{base_url}tags/page{i}.html', 'daily', '0.6'))
-
-    for url, changefreq, priority in sitemap_urls:
-        sitemap_content += '  <url>\n'
-        sitemap_content += f'    <loc>{url}</loc>\n'
-        sitemap_content += f'    <lastmod>{date.today().isoformat()}</lastmod>\n'
-        sitemap_content += f'    <changefreq>{changefreq}</changefreq>\n'
-        sitemap_content += f'    <priority>{priority}</priority>\n'
-        sitemap_content += '  </url>\n'
-    
-    sitemap_content += '</urlset>'
-    with open('sitemap.xml', 'w', encoding='utf-8') as f:
-        f.write(sitemap_content)
+    def write_entry(sitemap_file, url, changefreq, priority):
+        page_path = url[len(base_url):] or 'index.html'
+        try:
+            with open(page_path, 'rb') as f:
+                content_hash = hashlib.sha1(f.read()).hexdigest()[:16]
+        except OSError:
+            content_hash = ''
+        previous = previous_lastmod.get(page_path)
+        lastmod = previous[1] if previous and previous[0] == content_hash else today
+        lastmod_records[page_path] = [content_hash, lastmod]
+        _write_sitemap_entry(sitemap_file, url, changefreq, priority, lastmod)
+
+    with open('sitemap.xml.tmp', 'w', encoding='utf-8') as sitemap_file:
+        sitemap_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        sitemap_file.write('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for url, changefreq, priority in [
+            (base_url, 'daily', '1.0'),
+            (f'{base_url}privacy.html', 'monthly', '0.5'),
+            (f'{base_url}disclaimer.html', 'monthly', '0.5'),
+            (f'{base_url}contact.html', 'monthly', '0.5'),
+            (f'{base_url}search_results.html', 'daily', '0.5'),
+            (f'{base_url}ai_search.html', 'weekly', '0.7') # AIで探すのページを追加
+        ]:
+            write_entry(sitemap_file, url, changefreq, priority)
+
+        for product in products:
+            write_entry(sitemap_file, f'{base_url}{product.get("page_url", "")}', 'daily', '0.6')
+            all_tags.update(product.get('tags', []))
+            product_count += 1
+
+        total_pages = math.ceil(product_count / PRODUCTS_PER_PAGE)
+        for i in range(2, total_pages + 1):
+            write_entry(sitemap_file, f'{base_url}pages/page{i}.html', 'daily', '0.8')
+
+        # カテゴリーページを追加 (サブカテゴリーは削除)
+        for main_cat in list(PRODUCT_CATEGORIES.keys()) + ['その他']:
+            # メインカテゴリーのindex.htmlのみ追加
+            write_entry(sitemap_file, f'{base_url}category/{main_cat}/index.html', 'daily', '0.8')
+
+        # 特別カテゴリー（動的お得情報）も追加
+        for special_cat in ['最安値', '期間限定セール', 'ポイント特化']:
+            write_entry(sitemap_file, f'{base_url}category/{special_cat}/index.html', 'daily', '0.8')
+
+        # タグページを追加
+        all_tags = sorted(all_tags)
+        write_entry(sitemap_file, f'{base_url}tags/index.html', 'weekly', '0.7') # タグ一覧ページ
+        for tag in all_tags:
+            write_entry(sitemap_file, f'{base_url}tags/{_safe_tag_name(tag)}.html', 'daily', '0.6')
+
+        total_tag_pages = math.ceil(len(all_tags) / TAGS_PER_PAGE)
+        for i in range(2, total_tag_pages + 1):
+            write_entry(sitemap_file, f'{base_url}tags/page{i}.html', 'daily', '0.6')
+
+        sitemap_file.write('</urlset>')
+    _replace_if_changed('sitemap.xml.tmp', 'sitemap.xml')
     print("sitemap.xmlが生成されました。")
 
+    # 1行に1ページずつ、キーの順に書き出して差分を小さく保つ
+    write_if_changed(SITEMAP_LASTMOD_FILE, '{\n' + ',\n'.join(
+        f'{json.dumps(page_path, ensure_ascii=False)}: {json.dumps(record)}'
+        for page_path, record in sorted(lastmod_records.items())
+    ) + '\n}\n')
+
+def _price_bucket_key(price):
+    """価格が属する価格帯のキーを返す"""
+    for low, high, _label in PRICE_BUCKETS:
+        if high is None or price < high:
+            return f"{low}-{high or ''}"
+    return None
+
+def _main_category(product):
+    """商品のメインカテゴリー (定義にないものは「その他」)"""
+    main_cat = product.get('category', {}).get('main', 'その他')
+    return main_cat if main_cat in PRODUCT_CATEGORIES else 'その他'
+
+def _facet_category_path(main_cat):
+    return f"{FACET_CATEGORY_DIR}/{_safe_tag_name(main_cat)}.json"
+
+def _write_facet_index(facets, category_facets, category_docs_spools):
+    """
+    ファセットごとの商品番号リストを書き出す。商品番号はsearch_index.jsonでの並び順で、各リストは昇順に並ぶ。
+    一覧表示に必要な商品データは、カテゴリーページが自分のカテゴリーの分だけ読み込めるよう
+    カテゴリーごとのファイルに分け、そのファイル内の商品番号 (カテゴリー内での並び順) のリストと一緒に書き出す。
+    """
+    # クライアントでそのまま読み込むデータなので、空白を省いてサイズを抑える
+    def compact(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+    price_buckets = [{"key": f"{low}-{high or ''}", "label": label} for low, high, label in PRICE_BUCKETS]
+    categories = {main_cat: _facet_category_path(main_cat) for main_cat in sorted(category_docs_spools)}
+    with open(FACET_INDEX_FILE, 'w', encoding='utf-8') as f:
+        f.write('{"version":1,"price_buckets":' + compact(price_buckets))
+        f.write(',"categories":' + compact(categories))
+        f.write(',"facets":' + compact(facets) + '}')
+    print(f"{FACET_INDEX_FILE} が生成されました。")
+
+    os.makedirs(FACET_CATEGORY_DIR, exist_ok=True)
+    for main_cat, docs_spool in category_docs_spools.items():
+        with open(categories[main_cat], 'w', encoding='utf-8') as f:
+            f.write('{"version":1,"category":' + compact(main_cat) + ',"price_buckets":' + compact(price_buckets))
+            f.write(',"facets":' + compact(category_facets[main_cat]))
+            f.write(',"docs":[')
+            for doc_id, doc in enumerate(iter_spool(docs_spool)):
+                f.write((',' if doc_id else '') + compact(doc))
+            f.write(']}')
+    # 商品がなくなったカテゴリーのファイルを削除する
+    for file_name in os.listdir(FACET_CATEGORY_DIR):
+        path = f"{FACET_CATEGORY_DIR}/{file_name}"
+        if path not in categories.values():
+            os.remove(path)
+    print(f"{FACET_CATEGORY_DIR}/ に {len(categories)} カテゴリー分の絞り込みデータが生成されました。")
+
 # 検索用JSONを生成する関数
 def generate_search_index(products):
-    """JavaScriptが検索に使用するためのJSONデータファイルを生成する"""
+    """
+    JavaScriptが検索に使用するためのJSONデータファイルを、商品を1件ずつ書き出しながら生成する。
+    同じ走査でカテゴリー・価格帯・タグ・お得フラグごとのファセットインデックスも組み立てる。
+    """
     try:
-        search_data = []
-        for p in products:
-            # 検索対象となる情報をひとつの文字列にまとめる
-            search_text = f"{p['name']} {p.get('description', '')} {' '.join(p.get('tags', []))} {p.get('category', {}).get('main', '')} {p.get('category', {}).get('sub', '')}"
-            
-            search_data.append({
-                "id": p['id'],
-                "name": p['name'],
-                "page_url": p['page_url'],
-                "image_url": p['image_url'],
-                "price": p['price'],
-                "ai_headline": p.get('ai_headline', ''),
-                "searchable_text": search_text.lower() # 検索を効率化するため、小文字で保存
-            })
-            
-        with open('search_index.json', 'w', encoding='utf-8') as f:
-            json.dump(search_data, f, ensure_ascii=False, indent=2)
-        print("search_index.json が生成されました。")
+        facets = {"category": {}, "sub_category": {}, "price": {}, "tag": {}, "flag": {}}
+        # カテゴリーごとのファセット (カテゴリー内での商品番号) と、商品カードのデータの一時ファイル
+        category_facets = {}
+        category_counts = {}
+        category_docs_spools = {}
+        # 書き出す内容のハッシュをそのままインデックスのバージョンにする
+        content_hash = hashlib.sha256()
+        with open(SEARCH_INDEX_FILE, 'w', encoding='utf-8') as f:
+            def write(text):
+                f.write(text)
+                content_hash.update(text.encode('utf-8'))
+
+            count = 0
+            for p in products:
+                # 検索対象となる情報をひとつの文字列にまとめる
+                search_text = f"{p['name']} {p.get('description', '')} {' '.join(p.get('tags', []))} {p.get('category', {}).get('main', '')} {p.get('category', {}).get('sub', '')}"
+
+                entry = {
+                    "id": p['id'],
+                    "name": p['name'],
+                    "page_url": p['page_url'],
+                    "image_url": p['image_url'],
+                    "price": p['price'],
+                    "ai_headline": p.get('ai_headline', ''),
+                    "searchable_text": search_text.lower() # 検索を効率化するため、小文字で保存
+                }
+                # json.dump(indent=2) で配列全体を書き出した場合と同じ形式にする
+                entry_json = json.dumps(entry, ensure_ascii=False, indent=2).replace('\n', '\n  ')
+                write(('[\n  ' if count == 0 else ',\n  ') + entry_json)
+
+                # ファセット (商品番号を該当する値のリストに追加する)
+                # カテゴリーページと同じく、定義にないメインカテゴリーは「その他」にまとめる
+                main_cat = _main_category(p)
+                facet_values = [("category", main_cat)]
+                sub_cat = p.get('category', {}).get('sub')
+                if sub_cat:
+                    facet_values.append(("sub_category", f"{main_cat}/{sub_cat}"))
+                try:
+                    facet_values.append(("price", _price_bucket_key(int(str(p['price']).replace(',', '')))))
+                except (ValueError, KeyError):
+                    pass
+                facet_values.extend(("tag", tag) for tag in dict.fromkeys(p.get('tags', [])))
+                for flag, matches in [("sale", is_sale_product), ("point", is_point_product), ("new_lowest", is_new_lowest_product)]:
+                    if matches(p):
+                        facet_values.append(("flag", flag))
+
+                if main_cat not in category_docs_spools:
+                    category_docs_spools[main_cat] = tempfile.TemporaryFile('w+', encoding='utf-8')
+                    category_facets[main_cat] = {"sub_category": {}, "price": {}, "tag": {}, "flag": {}}
+                    category_counts[main_cat] = 0
+                for group, value in facet_values:
+                    facets[group].setdefault(value, []).append(count)
+                    if group != "category":
+                        category_facets[main_cat][group].setdefault(value, []).append(category_counts[main_cat])
+                category_counts[main_cat] += 1
+                category_docs_spools[main_cat].write(json.dumps([p['page_url'], p['name'], p['price'], p['image_url'], p.get('ai_headline', '')], ensure_ascii=False) + '\n')
+
+                count += 1
+            write('\n]' if count else '[]')
+        print(f"{SEARCH_INDEX_FILE} が生成されました。")
+
+        manifest = {"version": content_hash.hexdigest()[:16], "file": SEARCH_INDEX_FILE, "count": count}
+        with open(SEARCH_INDEX_MANIFEST_FILE, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        print(f"{SEARCH_INDEX_MANIFEST_FILE} が生成されました。")
+
+        _write_facet_index(facets, category_facets, category_docs_spools)
+        for docs_spool in category_docs_spools.values():
+            docs_spool.close()
     except Exception as e:
         print(f"検索インデックスの生成中にエラーが発生しました: {e}")
 
@@ -893,23 +2367,531 @@ def generate_search_results_page():
     </div>
 </main>
 """
-    with open(page_path, 'w', encoding='utf-8') as f:
-        f.write(header + main_content_html + footer)
+    write_if_changed(page_path, header + main_content_html + footer)
     print(f"{page_path} が生成されました。")
 
-def main():
-    new_products = fetch_rakuten_items()
-    final_products = update_products_csv(new_products)
-
-    generate_search_index(final_products)
+def iter_fetched_products():
+    """fetchステージが書き出した商品を1件ずつ読み込む"""
+    with open(FETCHED_PRODUCTS_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def run_fetch():
+    """楽天APIから商品を取得し、他のマーケットプレイスの価格を付けて fetched_products.jsonl に書き出す"""
+    tmp_path = FETCHED_PRODUCTS_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for product in attach_marketplace_offers(fetch_rakuten_items()):
+            f.write(json.dumps(product, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, FETCHED_PRODUCTS_FILE)
+
+def run_enrich():
+    """取得済みの商品をproducts.csvに統合し、AIによるデータ生成を行う"""
+    if not os.path.exists(FETCHED_PRODUCTS_FILE):
+        print(f"{FETCHED_PRODUCTS_FILE} が見つかりません。先に fetch を実行してください。")
+        return
+    try:
+        update_products_csv(iter_fetched_products())
+        evict_ai_cache()
+    finally:
+        close_ai_cache()
+
+def run_index():
+    """products.csvから検索インデックスと検索結果ページを生成する"""
+    generate_search_index(iter_cached_products())
     generate_search_results_page()
 
-    # AIで探す、ポイント特化のプレースホルダーページを生成
+def write_placeholder_pages():
+    """AIで探す、ポイント特化のプレースホルダーページを生成"""
     generate_placeholder_page("ai_search.html", "AIで探す", "AIがおすすめする商品を見つけよう！")
     # ポイント特化と期間限定セールは、generate_site 関数内で動的コンテンツとして生成されるが、
     # 処理フローのためにここでプレースホルダーも生成しておく
 
-    generate_site(final_products)
+def run_render(shard=None):
+    """products.csvから各ページのHTMLを生成する (shardを指定した場合は担当分のページのみ)"""
+    generate_site(iter_cached_products(), shard=shard)
+
+def run_sitemap():
+    """products.csvからsitemap.xmlを生成する"""
+    generate_sitemap(iter_cached_products())
+
+def run_merge(shards):
+    """分割ビルドの結果をまとめ、検索インデックスとsitemap.xmlを生成する"""
+    if not merge_shards(shards):
+        raise SystemExit(1)
+    run_index()
+    run_sitemap()
+
+def _page_kind(page_path, detail_paths):
+    """ページのパスから、TEMPLATE_PAGE_KINDS で使うページの種類を判定する"""
+    if page_path in detail_paths:
+        return 'detail'
+    if page_path == 'index.html' or re.fullmatch(r'pages/page\d+\.html', page_path):
+        return 'index'
+    if page_path in ("category/最安値/index.html", "category/ポイント特化/index.html"):
+        return 'leaderboard'
+    if page_path.startswith('category/'):
+        return 'category'
+    if page_path == 'tags/index.html' or re.fullmatch(r'tags/page\d+\.html', page_path):
+        return 'tag_index'
+    if page_path.startswith('tags/'):
+        return 'tag'
+    return None
+
+def _code_fingerprint(code):
+    """関数のコードを、行番号を除いて比較できる形にする (上の行を編集しても変更とみなさない)"""
+    return (code.co_code, code.co_names, code.co_varnames, tuple(
+        _code_fingerprint(const) if isinstance(const, types.CodeType) else const for const in code.co_consts
+    ))
+
+def _referenced_names(code):
+    """関数 (内側の関数やラムダを含む) が参照しているグローバル名"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _referenced_names(const)
+    return names
+
+def _module_fingerprints(module):
+    """モジュールの関数と定数 (JSONにできる大文字の名前) の比較用データ"""
+    fingerprints = {}
+    for name, value in vars(module).items():
+        if isinstance(value, types.FunctionType):
+            fingerprints[name] = (_code_fingerprint(value.__code__), value.__defaults__)
+        elif name.isupper():
+            try:
+                fingerprints[name] = json.dumps(value, ensure_ascii=False, sort_keys=True)
+            except TypeError:
+                pass
+    return fingerprints
+
+def _changed_page_kinds(old_module, new_module):
+    """読み込み直したモジュールで変わった関数から、再生成が必要なページの種類を求める"""
+    old_fingerprints = _module_fingerprints(old_module)
+    new_fingerprints = _module_fingerprints(new_module)
+    changed = {
+        name for name in old_fingerprints.keys() | new_fingerprints.keys()
+        if old_fingerprints.get(name) != new_fingerprints.get(name)
+    }
+    if not changed:
+        return set()
+    # 定数はどのページに影響するか追えないので、すべて再生成する
+    if any(name.isupper() for name in changed):
+        return set(ALL_PAGE_KINDS)
+
+    functions = {name: value for name, value in vars(new_module).items() if isinstance(value, types.FunctionType)}
+    kinds = set()
+    for root, root_kinds in TEMPLATE_PAGE_KINDS.items():
+        if root in changed:
+            # 一覧ページをまとめて生成する render_pages 自体の変更は、商品詳細ページにも影響しうる
+            kinds |= ALL_PAGE_KINDS if root == 'render_pages' else root_kinds
+            continue
+        # rootから呼ばれる関数をたどる (他のページ書き出し関数の先は、その関数の種類で扱う)
+        reachable = set()
+        stack = [root]
+        while stack:
+            name = stack.pop()
+            if name in reachable or name not in functions:
+                continue
+            reachable.add(name)
+            stack.extend(n for n in _referenced_names(functions[name].__code__) if n not in TEMPLATE_PAGE_KINDS)
+        if reachable & changed:
+            kinds |= root_kinds
+    return kinds
+
+def _load_site_module():
+    """generate_site.py を読み込み直し、編集後のテンプレート関数を持つモジュールを返す"""
+    spec = importlib.util.spec_from_file_location('generate_site_watch', os.path.abspath(__file__))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _read_store_rows():
+    """products.csvの各行を、パースせずに文字列のままIDごとに読み込む"""
+    if not os.path.exists(CACHE_FILE):
+        return {}
+    with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+        return {row['id']: row for row in csv.DictReader(f)}
+
+def _update_similar_products(model, product_ids):
+    """指定した商品の類似商品を計算し直す (他の商品の類似商品は前回の計算結果を使い続ける)"""
+    _card_offsets, neighbors = build_similar_products(
+        model['order'], is_query=lambda product: product['id'] in product_ids, term_cache=model['terms']
+    )
+    for row, neighbor_rows in neighbors.items():
+        model['similar'][model['order'][row]['id']] = [model['order'][i]['id'] for i in neighbor_rows]
+
+def _leaderboard_page_path(leaderboard_key):
+    """お得情報ランキングが載るページのパス"""
+    return "category/ポイント特化/index.html" if leaderboard_key == 'point' else "category/最安値/index.html"
+
+def _update_leaderboard_entries(leaderboards, product_id, product):
+    """
+    商品のランキングのエントリーを更新し (productがNoneなら削除し)、変更前後で商品が載るランキングのキーを返す。
+    ヒープ上の古いエントリーはすぐには取り除かず、上位を取り出すときに読み飛ばす。
+    """
+    old_entries = leaderboards['entries'].pop(product_id, {})
+    new_entries = {}
+    if product is not None:
+        sort_key = _date_sort_key(product)
+        # スコアの高い順、同点なら日付順で先に来る商品を優先する (render_pagesのランキングと同じ順序)
+        new_entries = {key: (-score, sort_key, product_id) for key, score in _leaderboard_scores(product).items()}
+        leaderboards['entries'][product_id] = new_entries
+    for key, entry in new_entries.items():
+        if old_entries.get(key) != entry:
+            heapq.heappush(leaderboards['heaps'].setdefault(key, []), entry)
+    for key, entry in old_entries.items():
+        if new_entries.get(key) != entry:
+            leaderboards['stale'][key] = leaderboards['stale'].get(key, 0) + 1
+    return old_entries.keys() | new_entries.keys()
+
+def _leaderboard_top(leaderboards, key):
+    """ヒープからランキング上位LEADERBOARD_SIZE件の商品IDを取り出す (取り出したエントリーはヒープに戻す)"""
+    heap = leaderboards['heaps'].get(key, [])
+    entries = leaderboards['entries']
+
+    def is_current(entry):
+        return entries.get(entry[2], {}).get(key) == entry
+
+    # 古いエントリーがヒープの半分を超えたら作り直す
+    if leaderboards['stale'].get(key, 0) * 2 > len(heap):
+        heap[:] = [entry for entry in heap if is_current(entry)]
+        heapq.heapify(heap)
+        leaderboards['stale'][key] = 0
+    top = []
+    while heap and len(top) < LEADERBOARD_SIZE:
+        entry = heapq.heappop(heap)
+        if is_current(entry):
+            top.append(entry)
+        else:
+            leaderboards['stale'][key] -= 1
+    for entry in top:
+        heapq.heappush(heap, entry)
+    return [product_id for _neg_score, _sort_key, product_id in top]
+
+def load_watch_model():
+    """
+    serve --watch で再生成に使うモデル (パース済みの商品、日付順の並び、類似商品、お得情報ランキングのヒープ) を作る。
+    以降は変更のあった行だけをパースし直してモデルを更新する。
+    """
+    raw_rows = _read_store_rows()
+    products = {product_id: _parse_cached_row(dict(row)) for product_id, row in raw_rows.items()}
+    model = {
+        "raw_rows": raw_rows,
+        "products": products,
+        "order": sorted(products.values(), key=_date_sort_key),
+        "similar": {},
+        # 類似商品の計算に使う商品ごとの語のレコード (build_similar_productsのterm_cache)
+        "terms": {"vocabulary": {}, "records": {}},
+        # ランキングごとのヒープ、商品ごとの現在のエントリー、ヒープに残る古いエントリーの数、前回の上位の商品ID
+        "leaderboards": {"heaps": {}, "entries": {}, "stale": {}, "tops": {}},
+        # 商品IDごとの、ページのディレクトリ → 商品カード (テンプレートを読み込み直したら作り直す)
+        "cards": {},
+        "card_module": None,
+    }
+    leaderboards = model['leaderboards']
+    for product_id, product in products.items():
+        _update_leaderboard_entries(leaderboards, product_id, product)
+    for key in leaderboards['heaps']:
+        leaderboards['tops'][key] = _leaderboard_top(leaderboards, key)
+    _update_similar_products(model, set(products))
+    return model
+
+def refresh_watch_model(model):
+    """products.csvの変更をモデルに反映し、再生成が必要なページのパスを返す"""
+    raw_rows = _read_store_rows()
+    changed_ids = {product_id for product_id, row in raw_rows.items() if model['raw_rows'].get(product_id) != row}
+    removed_ids = set(model['raw_rows']) - set(raw_rows)
+    if not changed_ids and not removed_ids:
+        return set()
+
+    products = model['products']
+    leaderboards = model['leaderboards']
+    old_order = [product['id'] for product in model['order']]
+    old_tags = {tag for product in model['order'] for tag in product.get('tags', [])}
+    # 変更前と変更後の両方の商品が載っていたページを再生成する
+    touched_products = []
+    touched_leaderboards = set()
+    for product_id in removed_ids:
+        product = products.pop(product_id)
+        touched_products.append(product)
+        model['similar'].pop(product_id, None)
+        if os.path.exists(product['page_url']):
+            os.remove(product['page_url'])
+    for product_id in changed_ids:
+        if product_id in products:
+            touched_products.append(products[product_id])
+        products[product_id] = _parse_cached_row(dict(raw_rows[product_id]))
+        touched_products.append(products[product_id])
+    for product_id in changed_ids | removed_ids:
+        model['terms']['records'].pop(product_id, None)
+        model['cards'].pop(product_id, None)
+        touched_leaderboards |= _update_leaderboard_entries(leaderboards, product_id, products.get(product_id))
+    model['raw_rows'] = raw_rows
+    model['order'] = sorted(products.values(), key=_date_sort_key)
+    new_order = [product['id'] for product in model['order']]
+
+    affected = set()
+    # トップページ: 並びが変わった場合はすべてのページ (減ったページも含む)、変わらなければ変更された商品が載っているページだけ
+    if new_order != old_order:
+        total_pages = math.ceil(max(len(new_order), len(old_order)) / PRODUCTS_PER_PAGE)
+        affected.add('index.html')
+        affected.update(f'pages/page{page_num}.html' for page_num in range(2, total_pages + 1))
+    else:
+        for position, product_id in enumerate(new_order):
+            if product_id in changed_ids:
+                page_num = position // PRODUCTS_PER_PAGE + 1
+                affected.add('index.html' if page_num == 1 else f'pages/page{page_num}.html')
+    # カテゴリー・タグのページと、変更前後の商品がセール商品ならセールのページ
+    for product in touched_products:
+        affected.add(f"category/{_main_category(product)}/index.html")
+        affected.update(f"tags/{_safe_tag_name(tag)}.html" for tag in product.get('tags', []))
+        if is_sale_product(product):
+            affected.add("category/期間限定セール/index.html")
+    # ランキングは、上位の顔ぶれか順位が変わったか、上位に載っている商品が変更された場合だけ
+    for key in touched_leaderboards:
+        top = _leaderboard_top(leaderboards, key)
+        if top != leaderboards['tops'].get(key) or changed_ids.intersection(top):
+            affected.add(_leaderboard_page_path(key))
+        leaderboards['tops'][key] = top
+    new_tags = {tag for product in model['order'] for tag in product.get('tags', [])}
+    if new_tags != old_tags:
+        total_tag_pages = math.ceil(max(len(new_tags), len(old_tags)) / TAGS_PER_PAGE)
+        affected.add('tags/index.html')
+        affected.update(f'tags/page{page_num}.html' for page_num in range(2, total_tag_pages + 1))
+
+    # 変更・削除された商品を類似商品として表示しているページと、変更された商品自身のページ
+    modified_ids = changed_ids | removed_ids
+    for product_id, neighbor_ids in model['similar'].items():
+        if product_id in products and any(neighbor_id in modified_ids for neighbor_id in neighbor_ids):
+            affected.add(products[product_id]['page_url'])
+    if changed_ids:
+        _update_similar_products(model, changed_ids)
+        affected.update(products[product_id]['page_url'] for product_id in changed_ids)
+    return affected
+
+def _render_affected_pages(module, model, page_paths, similar_products_for):
+    """
+    products.csvの変更の影響を受けたページ (page_paths) だけをモデルから生成する。
+    商品カードは載せるページの分だけ作り (モデルにキャッシュする)、ランキングはモデルのヒープの上位から作る。
+    """
+    rendered_pages = []
+    order = model['order']
+    if model['card_module'] is not module:
+        model['cards'] = {}
+        model['card_module'] = module
+
+    def card(product, page_path):
+        cards = model['cards'].setdefault(product['id'], {})
+        page_dir = os.path.dirname(page_path)
+        if page_dir not in cards:
+            cards[page_dir] = module.generate_product_card_html(product, page_path)
+        return cards[page_dir]
+
+    # トップページ
+    total_pages = math.ceil(len(order) / PRODUCTS_PER_PAGE)
+    for page_path in sorted(page_paths):
+        match = re.fullmatch(r'index\.html|pages/page(\d+)\.html', page_path)
+        page_num = int(match.group(1) or 1) if match else 0
+        if 1 <= page_num <= total_pages:
+            start = (page_num - 1) * PRODUCTS_PER_PAGE
+            module._write_index_page(page_num, total_pages, "".join(
+                card(product, page_path) for product in order[start:start + PRODUCTS_PER_PAGE]
+            ))
+            rendered_pages.append(page_path)
+
+    # カテゴリー・セール・タグのページに載せる商品を日付順に集める (カードは対象のページの分だけ作る)
+    sale_path = "category/期間限定セール/index.html"
+    category_products = {}
+    sale_products = []
+    tag_records = []
+    all_tags = set()
+    for seq, product in enumerate(order):
+        category_path = f"category/{module._main_category(product)}/index.html"
+        if category_path in page_paths:
+            category_products.setdefault(category_path, []).append(product)
+        if sale_path in page_paths and module.is_sale_product(product):
+            sale_products.append(product)
+        for tag in product.get('tags', []):
+            all_tags.add(tag)
+            tag_path = f"tags/{module._safe_tag_name(tag)}.html"
+            if tag_path in page_paths:
+                tag_records.append({"tag": tag, "seq": seq, "card": card(product, tag_path)})
+
+    for category_path, category_items in category_products.items():
+        page_file, footer = module._start_category_page(category_path.split('/')[1])
+        for product in category_items:
+            page_file.write(card(product, category_path))
+        module._finish_streamed_page(page_file, footer)
+        print(f"{category_path} が生成されました。")
+        rendered_pages.append(category_path)
+    if sale_path in page_paths:
+        page_file, footer = module._start_special_page('期間限定セール')
+        for product in sale_products:
+            page_file.write(card(product, sale_path))
+        module._finish_streamed_page(page_file, footer)
+        print(f"{sale_path} が生成されました。")
+        rendered_pages.append(sale_path)
+
+    # 最安値・ポイント特化: モデルのヒープから求めた上位の商品だけカードを作る
+    rendered_pages.extend(module._write_deal_leaderboard_pages(
+        lambda leaderboard_key: [
+            card(model['products'][product_id], _leaderboard_page_path(leaderboard_key))
+            for product_id in model['leaderboards']['tops'].get(leaderboard_key, [])
+        ],
+        lambda page_path: page_path in page_paths
+    ))
+
+    for tag in module._write_tag_pages(sorted(tag_records, key=lambda record: (record['tag'], record['seq']))):
+        rendered_pages.append(f"tags/{module._safe_tag_name(tag)}.html")
+    if 'tags/index.html' in page_paths:
+        rendered_pages.extend(module._write_tag_index_pages(sorted(all_tags)))
+
+    # 商品詳細ページ
+    for product in order:
+        if product['page_url'] in page_paths:
+            module._write_product_detail_page(product, similar_products_for(None, product))
+            rendered_pages.append(product['page_url'])
+    return rendered_pages
+
+def rebuild_watch_pages(module, model, kinds, page_paths):
+    """
+    モデルから、指定した種類のページ (テンプレートの変更) と指定したパスのページ (products.csvの変更) だけを再生成する。
+    指定したパスのうち生成されなかったページ (商品がなくなったタグやカテゴリーなど) は削除する。
+    """
+    detail_paths = {product['page_url'] for product in model['order']}
+
+    def similar_products_for(_seq, product):
+        return [model['products'][i] for i in model['similar'].get(product['id'], []) if i in model['products']]
+
+    rendered_pages = []
+    if kinds:
+        rendered_pages = module.render_pages(
+            model['order'], len(model['order']), similar_products_for,
+            lambda page_path: _page_kind(page_path, detail_paths) in kinds
+        )
+    rendered_pages += _render_affected_pages(
+        module, model, {page_path for page_path in page_paths if _page_kind(page_path, detail_paths) not in kinds},
+        similar_products_for
+    )
+    if 'search_results' in kinds:
+        module.generate_search_results_page()
+        rendered_pages.append("search_results.html")
+    if 'placeholder' in kinds:
+        module.write_placeholder_pages()
+        rendered_pages.append("ai_search.html")
+
+    for page_path in sorted(set(page_paths) - set(rendered_pages)):
+        if os.path.exists(page_path):
+            os.remove(page_path)
+            print(f"{page_path} を削除しました。")
+            page_dir = os.path.dirname(page_path)
+            if page_dir not in GENERATED_PAGE_DIRS and page_dir and not os.listdir(page_dir):
+                os.rmdir(page_dir)
+    return rendered_pages
+
+def serve(port, watch):
+    """
+    出力ディレクトリをローカルで配信する。watchを指定すると、products.csv・テンプレート (generate_site.py)・
+    静的ファイルを監視し、変更の影響を受けるページだけをメモリ上のモデルから再生成する。
+    """
+    import functools
+    import http.server
+    import threading
+
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=os.getcwd())
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    print(f"http://127.0.0.1:{port}/ で配信しています (Ctrl+C で終了)。")
+    if not watch:
+        server.serve_forever()
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    template_path = os.path.abspath(__file__)
+    watched_paths = [CACHE_FILE, template_path] + WATCHED_ASSETS
+    module = _load_site_module()
+    start_time = time.perf_counter()
+    model = load_watch_model()
+    rebuild_watch_pages(module, model, ALL_PAGE_KINDS, set())
+    print(f"{len(model['order'])} 件の商品でサイトを生成しました ({time.perf_counter() - start_time:.2f}秒)。変更を監視しています...")
+
+    def snapshot():
+        return {path: os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in watched_paths}
+
+    mtimes = snapshot()
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            current_mtimes = snapshot()
+            changed_paths = [path for path in watched_paths if current_mtimes[path] != mtimes[path]]
+            mtimes = current_mtimes
+            if not changed_paths:
+                continue
+
+            start_time = time.perf_counter()
+            kinds = set()
+            page_paths = set()
+            if template_path in changed_paths:
+                try:
+                    new_module = _load_site_module()
+                except Exception as e:
+                    # 編集途中の構文エラーなどは、次に保存されるまで前のテンプレートを使い続ける
+                    print(f"テンプレートの読み込みに失敗しました: {e}")
+                else:
+                    kinds = _changed_page_kinds(module, new_module)
+                    module = new_module
+            if CACHE_FILE in changed_paths:
+                page_paths = refresh_watch_model(model)
+                if page_paths:
+                    module.generate_search_index(model['products'][product_id] for product_id in model['raw_rows'])
+            for path in changed_paths:
+                if path in WATCHED_ASSETS:
+                    print(f"{path} が変更されました (ブラウザを再読み込みすると反映されます)。")
+            if kinds or page_paths:
+                rendered_pages = rebuild_watch_pages(module, model, kinds, page_paths)
+                print(f"{len(rendered_pages)} ページを再生成しました ({time.perf_counter() - start_time:.2f}秒)。")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+# 各ステージは products.csv (IDの昇順) を介して商品を受け渡すため、個別にも実行できる
+STAGES = {
+    'fetch': (run_fetch, "楽天APIから商品を取得し、他のマーケットプレイスの価格と照合する"),
+    'enrich': (run_enrich, "取得した商品をproducts.csvに統合し、AIデータを生成する"),
+    'index': (run_index, "検索インデックスを生成する"),
+    'render': (run_render, "HTMLページを生成する"),
+    'sitemap': (run_sitemap, "sitemap.xmlを生成する"),
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="カイドキ-ナビのサイトを生成する")
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    stage_parsers = {name: subparsers.add_parser(name, help=help_text) for name, (_func, help_text) in STAGES.items()}
+    stage_parsers['render'].add_argument(
+        '--shard', type=parse_shard, metavar='i/N',
+        help="ページのパスのハッシュでN分割したうちi番目 (1始まり) のページだけを生成する"
+    )
+    subparsers.add_parser('all', help="fetch から sitemap までのすべてのステージを順に実行する (省略時)")
+    merge_parser = subparsers.add_parser('merge', help="render --shard の結果をまとめ、検索インデックスとsitemap.xmlを生成する")
+    merge_parser.add_argument('--shards', type=int, required=True, metavar='N', help="シャード数")
+    serve_parser = subparsers.add_parser('serve', help="生成したサイトをローカルで配信する")
+    serve_parser.add_argument('--port', type=int, default=8000, help="配信するポート (既定: 8000)")
+    serve_parser.add_argument('--watch', action='store_true', help="変更を監視し、影響するページだけを再生成する")
+    args = parser.parse_args(argv)
+
+    command = args.command or 'all'
+    if command == 'merge':
+        run_merge(args.shards)
+        return
+    if command == 'serve':
+        serve(args.port, args.watch)
+        return
+    stage_names = list(STAGES) if command == 'all' else [command]
+    # サブコマンドで指定されたオプションは、そのステージにだけ渡す
+    stage_options = {key: value for key, value in vars(args).items() if key != 'command'}
+    for name in stage_names:
+        start_time = time.perf_counter()
+        STAGES[name][0](**(stage_options if name == command else {}))
+        print(f"ステージ '{name}' が完了しました ({time.perf_counter() - start_time:.2f}秒)。")
 
 def generate_placeholder_page(page_path, title, description):
     """シンプルなプレースホルダーページを生成する"""
@@ -924,8 +2906,7 @@ def generate_placeholder_page(page_path, title, description):
     </div>
 </main>
 """
-    with open(page_path, 'w', encoding='utf-8') as f:
-        f.write(header + main_content_html + footer)
+    write_if_changed(page_path, header + main_content_html + footer)
     print(f"{page_path} (プレースホルダー) が生成されました。")
 
 
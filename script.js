@@ -48,15 +48,47 @@ document.addEventListener('DOMContentLoaded', function() {
 
 /**
  * 検索インデックスを読み込み、検索を実行する
+ * Web Workerが使える環境では、インデックスの取得と絞り込みをWorkerに任せてメインスレッドを空けておく
  * @param {string} query - 検索キーワード
  * @param {HTMLElement} container - 結果を表示するDOM要素
  * @param {HTMLElement} loadingElement - ローディングメッセージを表示するDOM要素
  */
 function fetchSearchIndex(query, container, loadingElement) {
     const rootPath = document.querySelector('link[rel="stylesheet"]').getAttribute('href').replace('style.css', '');
-    const searchIndexUrl = `${rootPath}search_index.json`;
     const lowerQuery = query.toLowerCase();
-    
+
+    if (!window.Worker) {
+        fetchSearchIndexOnMainThread(rootPath, lowerQuery, container, loadingElement);
+        return;
+    }
+
+    const worker = new Worker(`${rootPath}search_worker.js`);
+    worker.addEventListener('message', (event) => {
+        if (event.data.error) {
+            console.error('Error in search worker:', event.data.error);
+            showSearchError(container, loadingElement);
+            return;
+        }
+        renderSearchResults(event.data.results, container, lowerQuery);
+    });
+    worker.addEventListener('error', (error) => {
+        // Workerを起動できない場合は従来どおりメインスレッドで検索する
+        console.error('Search worker failed:', error);
+        fetchSearchIndexOnMainThread(rootPath, lowerQuery, container, loadingElement);
+    });
+    worker.postMessage({ query: query, rootPath: rootPath });
+}
+
+/**
+ * Web Workerが使えない環境向けに、メインスレッドで検索を実行する
+ * @param {string} rootPath - サイトのルートへの相対パス
+ * @param {string} lowerQuery - 小文字に変換した検索キーワード
+ * @param {HTMLElement} container - 結果を表示するDOM要素
+ * @param {HTMLElement} loadingElement - ローディングメッセージを表示するDOM要素
+ */
+function fetchSearchIndexOnMainThread(rootPath, lowerQuery, container, loadingElement) {
+    const searchIndexUrl = `${rootPath}search_index.json`;
+
     fetch(searchIndexUrl)
         .then(response => {
             if (!response.ok) {
@@ -74,11 +106,20 @@ function fetchSearchIndex(query, container, loadingElement) {
         })
         .catch(error => {
             console.error('Error loading search index:', error);
-            if (loadingElement) loadingElement.textContent = '検索インデックスの読み込みに失敗しました。';
-            container.innerHTML = `<p class="col-span-full text-center text-red-500 py-8 border border-dashed rounded-lg">検索処理中にエラーが発生しました。</p>`;
+            showSearchError(container, loadingElement);
         });
 }
 
+/**
+ * 検索処理のエラーを表示する
+ * @param {HTMLElement} container - 結果を表示するDOM要素
+ * @param {HTMLElement} loadingElement - ローディングメッセージを表示するDOM要素
+ */
+function showSearchError(container, loadingElement) {
+    if (loadingElement) loadingElement.textContent = '検索インデックスの読み込みに失敗しました。';
+    container.innerHTML = `<p class="col-span-full text-center text-red-500 py-8 border border-dashed rounded-lg">検索処理中にエラーが発生しました。</p>`;
+}
+
 /**
  * 検索結果をDOMにレンダリングする
  * @param {Array<Object>} results - 検索結果の商品配列
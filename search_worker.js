@@ -0,0 +1,109 @@
+/**
+ * サイト内検索をメインスレッドの外で実行するWeb Worker
+ * 検索インデックスはIndexedDBに保存し、search_index_version.json のバージョンが変わった時だけ再取得する
+ */
+const DB_NAME = 'kaidoki-navi';
+const STORE_NAME = 'search-index';
+const RECORD_KEY = 'current';
+
+// 同じWorkerで続けて検索する場合は、読み込み済みのインデックスを使い回す
+let loadedIndex = null;
+
+self.addEventListener('message', (event) => {
+    const { query, rootPath } = event.data;
+    loadSearchIndex(rootPath)
+        .then(products => {
+            const lowerQuery = query.toLowerCase();
+            const results = products.filter(product => product.searchable_text.includes(lowerQuery));
+            // 検索用テキストは画面表示に不要なので、結果からは除いて返す
+            self.postMessage({
+                results: results.map(({ searchable_text, ...product }) => product)
+            });
+        })
+        .catch(error => {
+            self.postMessage({ error: String(error) });
+        });
+});
+
+/**
+ * IndexedDBを開く
+ * @returns {Promise<IDBDatabase>}
+ */
+function openDatabase() {
+    return new Promise((resolve, reject) => {
+        const request = indexedDB.open(DB_NAME, 1);
+        request.onupgradeneeded = () => request.result.createObjectStore(STORE_NAME);
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+/**
+ * IndexedDBに保存されている検索インデックスを読み出す
+ * @param {IDBDatabase} db
+ * @returns {Promise<{version: string, products: Array<Object>}|undefined>}
+ */
+function readCachedIndex(db) {
+    return new Promise((resolve, reject) => {
+        const request = db.transaction(STORE_NAME, 'readonly').objectStore(STORE_NAME).get(RECORD_KEY);
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+/**
+ * 検索インデックスをIndexedDBに保存する
+ * @param {IDBDatabase} db
+ * @param {{version: string, products: Array<Object>}} record
+ * @returns {Promise<void>}
+ */
+function writeCachedIndex(db, record) {
+    return new Promise((resolve, reject) => {
+        const transaction = db.transaction(STORE_NAME, 'readwrite');
+        transaction.objectStore(STORE_NAME).put(record, RECORD_KEY);
+        transaction.oncomplete = () => resolve();
+        transaction.onerror = () => reject(transaction.error);
+    });
+}
+
+/**
+ * 最新バージョンの検索インデックスを返す。バージョンが変わっていなければネットワークからは取得しない
+ * @param {string} rootPath - サイトのルートへの相対パス
+ * @returns {Promise<Array<Object>>}
+ */
+async function loadSearchIndex(rootPath) {
+    const manifestResponse = await fetch(new URL(`${rootPath}search_index_version.json`, self.location.href), { cache: 'no-cache' });
+    if (!manifestResponse.ok) {
+        throw new Error('Search index manifest not found.');
+    }
+    const manifest = await manifestResponse.json();
+
+    if (loadedIndex && loadedIndex.version === manifest.version) {
+        return loadedIndex.products;
+    }
+
+    let db = null;
+    try {
+        db = await openDatabase();
+        const cached = await readCachedIndex(db);
+        if (cached && cached.version === manifest.version) {
+            loadedIndex = cached;
+            return cached.products;
+        }
+    } catch (error) {
+        // プライベートブラウズなどでIndexedDBが使えない場合は、毎回ダウンロードする
+        console.warn('IndexedDB is not available:', error);
+    }
+
+    // バージョンをURLに含め、HTTPキャッシュに残った古いインデックスを使わないようにする
+    const indexUrl = new URL(`${rootPath}${manifest.file}?v=${manifest.version}`, self.location.href);
+    const indexResponse = await fetch(indexUrl);
+    if (!indexResponse.ok) {
+        throw new Error('Search index file not found.');
+    }
+    loadedIndex = { version: manifest.version, products: await indexResponse.json() };
+    if (db) {
+        await writeCachedIndex(db, loadedIndex).catch(error => console.warn('Failed to cache search index:', error));
+    }
+    return loadedIndex.products;
+}